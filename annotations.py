@@ -0,0 +1,115 @@
+import csv
+import os
+
+import pandas as pd
+
+# Columns pre-filled into the form for each ROI
+SUGGESTION_FIELDS = ['suggested_class', 'suggested_label', 'validator_name', 'comment']
+
+# Form inputs -> columns of XP_final_annotations they are written to
+EDIT_COLUMNS = {
+    'group_input': 'validated_class',
+    'scientific_name_input': 'validated_specie',
+    'validator_name_input': 'validator_name',
+    'comment_input': 'comment',
+}
+
+
+def index_annotations(records):
+    # Frame indexed on filename_ts, rows kept in sheet order (position i is sheet row i + 2)
+    df = pd.DataFrame(records)
+    if 'filename_ts' not in df.columns:
+        df['filename_ts'] = ''
+    df.index = pd.Index(df['filename_ts'], name=None)
+    # Remember the sheet's header so row-level writeback can tell when the layout no longer matches
+    df.attrs['sheet_columns'] = list(df.columns)
+    return df
+
+
+def unannotated_mask(annotations_df):
+    # A ROI still needs work while any of its validated fields is left at 0
+    return ((annotations_df['validated_class'] == 0) |
+            (annotations_df['validated_specie'] == 0) |
+            (annotations_df['validator_name'] == 0))
+
+
+def lookup_suggestions(annotations_df, file_names, fields=SUGGESTION_FIELDS):
+    # One vectorized lookup for a batch of ROIs; unknown files get empty strings
+    first = annotations_df[~annotations_df.index.duplicated(keep='first')]
+    suggestions = first[fields].astype(object).reindex(file_names)
+    return suggestions.where(suggestions.notna(), '')
+
+
+def apply_annotations(annotations_df, annotations):
+    # Write all form edits with one aligned update; returns the filenames whose values changed
+    if not annotations:
+        return []
+    edits = pd.DataFrame(annotations).set_index('file_name').rename(columns=EDIT_COLUMNS)
+    edits = edits[list(EDIT_COLUMNS.values())]
+    edits = edits[~edits.index.duplicated(keep='last')]
+    mask = annotations_df.index.isin(edits.index)
+    columns = list(edits.columns)
+    for column in columns:
+        if column not in annotations_df.columns:
+            annotations_df[column] = ''
+    annotations_df[columns] = annotations_df[columns].astype(object)
+    new_values = edits.reindex(annotations_df.index[mask])
+    # Only rows whose values actually differ count as changed, so untouched ROIs are never written back
+    changed = (annotations_df.loc[mask, columns].astype(str).values != new_values.astype(str).values).any(axis=1)
+    annotations_df.loc[mask, columns] = new_values.values
+    return annotations_df.index[mask][changed].unique().tolist()
+
+
+def changes_path(csv_file):
+    return f"{os.path.splitext(csv_file)[0]}.changes.csv"
+
+
+def save_local_changes(csv_file, annotations_df, changed_files, compact_every=5000):
+    # Append changed rows to a change log next to the CSV, and fold the log into the CSV from time to time
+    log_file = changes_path(csv_file)
+    if not os.path.exists(csv_file):
+        compact_local_annotations(csv_file, annotations_df)
+        return
+    if not changed_files:
+        return
+    log_exists = os.path.exists(log_file)
+    # Rows are appended under the existing header: columns added or reordered since need a full rewrite
+    if _csv_header(log_file if log_exists else csv_file) != [str(c) for c in annotations_df.columns]:
+        compact_local_annotations(csv_file, annotations_df)
+        return
+    rows = annotations_df[annotations_df.index.isin(changed_files)]
+    rows.to_csv(log_file, mode='a', header=not log_exists, index=False)
+    with open(log_file) as f:
+        logged = sum(1 for _ in f) - 1
+    if logged >= compact_every:
+        compact_local_annotations(csv_file, annotations_df)
+
+
+def _csv_header(path):
+    with open(path, newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def compact_local_annotations(csv_file, annotations_df):
+    # annotations_df is the full, current table: rewrite the CSV atomically and drop the log
+    tmp_file = f"{csv_file}.tmp"
+    annotations_df.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, csv_file)
+    log_file = changes_path(csv_file)
+    if os.path.exists(log_file):
+        os.remove(log_file)
+
+
+def read_local_annotations(csv_file, **kwargs):
+    # The CSV with the change log replayed on top (last change for a filename_ts wins);
+    # kwargs go to both pd.read_csv calls
+    df = pd.read_csv(csv_file, **kwargs)
+    log_file = changes_path(csv_file)
+    if os.path.exists(log_file):
+        changes = pd.read_csv(log_file, **kwargs)
+        changes = changes.drop_duplicates('filename_ts', keep='last').set_index('filename_ts')
+        columns = [c for c in changes.columns if c in df.columns]
+        mask = df['filename_ts'].isin(changes.index)
+        df[columns] = df[columns].astype(object)
+        df.loc[mask, columns] = changes.reindex(df.loc[mask, 'filename_ts'])[columns].values
+    return df
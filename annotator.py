@@ -3,20 +3,33 @@ import os
 import pandas as pd
 import gspread
 from google.oauth2 import service_account
-import glob
-import soundfile as sf
-from maad import sound
-from maad.util import power2dB
-from skimage import transform
+import io
 import logging
-import zipfile
-import tempfile
-from datetime import datetime
-import matplotlib.pyplot as plt
+import threading
+from annotations import apply_annotations, index_annotations, lookup_suggestions, save_local_changes
+from sheets import SheetsCache
+from audio import clip_duration, open_clip
+from uploads import UploadStore
+from status import DONE, IN_PROGRESS, AnnotationStatus, status_key
+from spectrogram import SpectrogramCache, SpectrogramRenderer, colorize, spec_key
+from local_store import LocalAnnotationStore, SyncWorker
+from fake_sheets import FakeClient
+from progress import ClusterIndex
+from bundle import BundleCache, bundle_path
+from features import FeatureIndex, spec_descriptor
+from tiles import PyramidStore
+import perf
+
+
+def setting(name, default=None):
+    # Optional tuning knobs live in the [annotator] section of secrets.toml
+    return st.secrets.get("annotator", {}).get(name, default)
+
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=setting("log_level", "INFO"))
 logger = logging.getLogger(__name__)
+perf.configure(log_path=setting("perf_log"))
 
 
 @st.cache_resource
@@ -27,79 +40,192 @@ def authorize_google_sheets():
     return client
 
 
+@st.cache_resource
+def offline_sheets_client():
+    # Local stand-in for Google Sheets, seeded from the CSV exports in the "offline_sheets" directory
+    return FakeClient.from_csv_dir(setting("offline_sheets"))
+
+
+@st.cache_resource
+def get_sheets():
+    # Shared by all sessions: widget reruns are served from here instead of the Sheets API
+    get_client = offline_sheets_client if setting("offline_sheets") else authorize_google_sheets
+    return SheetsCache(get_client, ttl=int(setting("sheets_ttl", 60)))
+
+
+@st.cache_resource
+def get_local_store():
+    # Submits are committed here first; the sync worker pushes them to the sheet
+    return LocalAnnotationStore(setting("local_store", "annotations.sqlite3"))
+
+
+@st.cache_resource
+def get_sync_worker():
+    return SyncWorker(get_local_store(), get_sheets(), batch_size=int(setting("sync_batch_size", 500)),
+                      interval=float(setting("sync_interval", 10)))
+
+
 def get_google_sheet_data():
-    client = authorize_google_sheets()
-    sheet = client.open("XP_final_annotations").worksheet("rec1tes")
-    data = sheet.get_all_records()
+    data = get_sheets().records("XP_final_annotations", "rec1tes")
     df = pd.DataFrame(data)
     return df
 
 
-def get_annotation_status():
-    client = authorize_google_sheets()
-    sheet = client.open("XP_annotation_status").worksheet("status")
-    data = sheet.get_all_records()
-    df = pd.DataFrame(data)
-    # Ensure required columns are present
-    if 'cluster_folder' not in df.columns:
-        df['cluster_folder'] = ''
-    if 'user' not in df.columns:
-        df['user'] = ''
-    if 'status' not in df.columns:
-        df['status'] = ''
-    if 'timestamp' not in df.columns:
-        df['timestamp'] = ''
-    return df
+@st.cache_resource
+def get_status_service():
+    # Shared by all sessions so claims are serialized and the status table is read at most once per TTL
+    return AnnotationStatus(get_sheets(), ttl=int(setting("status_ttl", 30)),
+                            claim_expiry=int(setting("claim_expiry", 4 * 3600)))
 
 
-def update_annotation_status(cluster_folder, user, status):
-    client = authorize_google_sheets()
-    sheet = client.open("XP_annotation_status").worksheet("status")
-    df = get_annotation_status()
-    idx = df[df['cluster_folder'] == cluster_folder].index
-    if not idx.empty:
-        sheet.update_cell(idx[0] + 2, 2, user)
-        sheet.update_cell(idx[0] + 2, 3, status)
-        sheet.update_cell(idx[0] + 2, 4, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    else:
-        sheet.append_row([cluster_folder, user, status, datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
+def get_upload_store():
+    # One store per session; its extraction cache is removed when the session state is dropped
+    if 'upload_store' not in st.session_state:
+        st.session_state.upload_store = UploadStore()
+    return st.session_state.upload_store
 
 
-@st.cache_data
-def load_audio_files(folder):
-    audio_files = glob.glob(os.path.join(folder, "*.WAV"))
-    logger.debug(f"Audio files loaded from {folder}: {audio_files}")
-    return sorted(audio_files)  # Sort audio files alphabetically
-
-
-#@st.cache_data
-def plot_spec(file_path, cmap: str):
-    import matplotlib.pyplot as plt
-    s, fs = sound.load(file_path)
-    duration = len(s) / fs
-
-    # Adjust figure size based on the duration of the audio file
-    if duration < 1:
-        fig_size = (2, 2)
-    elif duration < 2:
-        fig_size = (2.5, 2)
-    elif duration < 3:
-        fig_size = (4, 2.5)
-    else:
-        fig_size = (5, 3.5)
-    Sxx, tn, fn, ext = sound.spectrogram(s, fs, nperseg=1024, noverlap=512, flims=(0, fs // 2))
-    Sxx_db = power2dB(Sxx, db_range=70)
-    Sxx_db = transform.rescale(Sxx_db, 0.5, anti_aliasing=True, channel_axis=None)
-    fig, ax = plt.subplots(figsize=fig_size)
-    img = ax.imshow(Sxx_db, aspect='auto', extent=ext, origin='lower', interpolation='bilinear', cmap=cmap)
-    fig.colorbar(img, ax=ax, format="%+2.0f dB")
-    ax.set(title='', xlabel='Time [s]', ylabel='Frequency [Hz]')
-    plt.tight_layout()
-    spectrogram_path = 'temp_spectrogram.png'
-    plt.savefig(spectrogram_path)
-    plt.close(fig)
-    st.image(spectrogram_path)
+@st.cache_resource
+def get_bundle_cache():
+    # Bundles are memory-mapped once per process
+    return BundleCache()
+
+
+def get_bundle(rec_name):
+    # Bundle written by prerender.py for this recorder, or None when there is none in "bundle_dir"
+    bundle_dir = setting("bundle_dir")
+    if not bundle_dir:
+        return None
+    path = bundle_path(bundle_dir, rec_name)
+    if not os.path.exists(path):
+        return None
+    return get_bundle_cache().get(path)
+
+
+@st.cache_resource
+def get_feature_indexes():
+    # rec_name -> FeatureIndex, shared by all sessions
+    return {}
+
+
+def get_feature_index(rec_name, bundle=None):
+    # A bundle carries descriptors for every ROI; without one the index fills up as subfolders are rendered
+    indexes = get_feature_indexes()
+    index = indexes.get(rec_name)
+    if bundle is not None and (index is None or index.source is not bundle):
+        index = indexes[rec_name] = FeatureIndex(bundle.features, bundle.feature_keys(), source=bundle)
+    elif index is None:
+        index = indexes[rec_name] = FeatureIndex()
+    return index
+
+
+@st.cache_resource
+def get_spec_cache():
+    # Shared across sessions: rendered spectrograms keyed by file content and display parameters
+    max_mb = setting("spec_cache_mb", 256)
+    disk_dir = setting("spec_cache_dir")
+    return SpectrogramCache(max_bytes=int(max_mb) * 1024 * 1024, disk_dir=disk_dir)
+
 
+@st.cache_resource
+def get_db_cache():
+    # Normalized dB levels, kept apart from the PNGs so a colormap change skips the STFT
+    max_mb = setting("db_cache_mb", 256)
+    disk_dir = setting("spec_cache_dir")
+    return SpectrogramCache(max_bytes=int(max_mb) * 1024 * 1024, disk_dir=disk_dir, suffix='.spec')
+
+
+@st.cache_resource
+def get_spec_renderer():
+    # One process pool per server process; "render_workers" defaults to the number of CPUs
+    workers = setting("render_workers")
+    return SpectrogramRenderer(get_spec_cache(), workers=int(workers) if workers else None,
+                               spec_cache=get_db_cache())
+
+
+@st.cache_resource
+def get_pyramid_store():
+    # Tile pyramids of long ROIs, shared by all sessions; "tile_cache_dir" keeps them across restarts
+    return PyramidStore(setting("tile_cache_dir"))
+
+
+def tile_min_seconds():
+    # ROIs at least this long are shown from a tile pyramid rather than a full-resolution STFT
+    return float(setting("tile_min_seconds", 30))
+
+
+def is_long(clip):
+    return clip.duration >= tile_min_seconds()
+
+
+def prefetch_rois(renderer, pyramids, audio_files, cmap, min_seconds):
+    # Background warm-up of ROIs about to be shown: short ones are rendered, long ones get their tile pyramid
+    short = []
+    for audio_file in audio_files:
+        if clip_duration(audio_file) >= min_seconds:
+            pyramids.prefetch(audio_file)
+        else:
+            short.append(audio_file)
+    if short:
+        renderer.prefetch(short, cmap)
+
+
+def pyramid_png(clip, cmap, t0=0.0, t1=None):
+    # Overview (whole ROI) or zoomed view of a long ROI, from the coarsest pyramid level that has enough detail
+    pyramid = get_pyramid_store().get(clip.digest, io.BytesIO(clip.data))
+    t1 = pyramid.duration if t1 is None else t1
+    key = f"{spec_key(clip.digest, cmap)}_tiles_{t0:.2f}_{t1:.2f}"
+    png = get_spec_cache().get(key)
+    if png is None:
+        png = colorize(pyramid.view(t0, t1), cmap, size=(900, 300))
+        get_spec_cache().put(key, png)
+    return png
+
+
+def zoom_long_rois(file_names, clips, cmap):
+    long_clips = {file_name: clip for file_name, clip in zip(file_names, clips) if is_long(clip)}
+    if not long_clips:
+        return
+    with st.expander("**:violet[Zoom into long ROIs]**"):
+        file_name = st.selectbox("ROI", list(long_clips), key="zoom_roi")
+        clip = long_clips[file_name]
+        t0, t1 = st.slider("Time range [s]", min_value=0.0, max_value=float(clip.duration),
+                           value=(0.0, min(float(clip.duration), 10.0)), step=0.1, key=f"zoom_{file_name}")
+        if t1 > t0:
+            st.image(pyramid_png(clip, cmap, t0, t1))
+
+
+def next_subfolder(folders, folder, subfolder):
+    # The subfolder the annotator will most likely open after the current one
+    subfolders = folders.get(folder, [])
+    if subfolder in subfolders and subfolders.index(subfolder) + 1 < len(subfolders):
+        return folder, subfolders[subfolders.index(subfolder) + 1]
+    keys = list(folders.keys())
+    for next_folder in keys[keys.index(folder) + 1:] if folder in keys else []:
+        if folders[next_folder]:
+            return next_folder, folders[next_folder][0]
+    return None, None
+
+
+def prefetch_subfolder(upload_store, folder, subfolder, cmap, page_size):
+    # Extract a subfolder in the background, then warm up the first page the form will show
+    renderer, pyramids, min_seconds = get_spec_renderer(), get_pyramid_store(), tile_min_seconds()
+
+    def render(future):
+        if future.exception() is None and future.result():
+            _, _, first, last = page_bounds(len(future.result()), page_size, 0)
+            prefetch_rois(renderer, pyramids, future.result()[first:last], cmap, min_seconds)
+
+    upload_store.extract_async(folder, subfolder).add_done_callback(render)
+
+
+def page_bounds(n_items, page_size, page):
+    # (number of pages, clamped page, first index, end index); page_size <= 0 shows everything on one page
+    if page_size <= 0 or n_items <= page_size:
+        return 1, 0, 0, n_items
+    n_pages = -(-n_items // page_size)
+    page = max(0, min(page, n_pages - 1))
+    return n_pages, page, page * page_size, min((page + 1) * page_size, n_items)
 
 
 @st.cache_data
@@ -107,236 +233,517 @@ def spacing():
     st.markdown("<br></br>", unsafe_allow_html=True)
 
 
-def update_google_sheet(client, rec_name, annotations_df):
-    sheet = client.open("XP_final_annotations").worksheet(rec_name)
-    sheet.clear()  # Clear existing data
-    sheet.update([annotations_df.columns.values.tolist()] + annotations_df.values.tolist())
+REC_NAMES = ['rec1dmu', 'rec3dmu', 'rec3dmu_v2', 'rec4dmu', 'rec4dmu_v2', 'rec6dmu', 'rec7dmu']
 
 
+@st.cache_resource
+def get_annotation_frames():
+    # rec_name -> (records, indexed frame), shared by all sessions so submits show up for everyone
+    return {}
 
-def plot_pie_chart(annotations_df):
-    total_clusters = len(annotations_df['cluster_number'].unique())
-    annotated_clusters = annotations_df[annotations_df['validated_class'] != 0]['cluster_number'].nunique()
-    remaining_clusters = total_clusters - annotated_clusters
+
+@st.cache_resource
+def annotation_lock(rec_name):
+    # Guards a recorder's shared frame: submits edit it in place while other sessions read it
+    return threading.RLock()
+
+
+def load_annotations(rec_name, records):
+    # Indexed once per fetched version of the recorder's sheet, then updated in place by submits
+    frames = get_annotation_frames()
+    with annotation_lock(rec_name):
+        source, annotations_df = frames.get(rec_name, (None, None))
+        if source is not records:
+            annotations_df = index_annotations(records)
+            # Edits submitted here but not yet synced to the sheet
+            get_local_store().overlay(rec_name, annotations_df)
+            frames[rec_name] = (records, annotations_df)
+        return annotations_df
+
+
+@st.cache_resource
+def get_cluster_indexes():
+    # rec_name -> ClusterIndex, shared by all sessions so submits show up for everyone
+    return {}
+
+
+def get_cluster_index(rec_name, records, annotations_df=None):
+    # Built once per fetched version of the recorder's sheet, then kept current by submits
+    indexes = get_cluster_indexes()
+    with annotation_lock(rec_name):
+        index = indexes.get(rec_name)
+        if index is None or index.source is not records:
+            if annotations_df is None:
+                annotations_df = load_annotations(rec_name, records)
+            index = indexes[rec_name] = ClusterIndex(annotations_df, source=records)
+        return index
+
+
+@st.cache_data
+def pie_chart_png(annotated_clusters, remaining_clusters):
+    # Drawn once per pair of counts rather than on every rerun
     labels = 'Annotated', 'Unannotated'
     sizes = [annotated_clusters, remaining_clusters]
     colors = ['#1fd655', '#ff9999']
     explode = (0.1, 0)  # explode the 1st slice
-    fig1, ax1 = plt.subplots(figsize=(1, 1))
-    ax1.pie(sizes, explode=explode, labels=labels, colors=colors, autopct='%1.0f%%',
-            shadow=True, startangle=90)
-    ax1.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-    plt.rcParams['font.size'] = 9.0
-    st.pyplot(fig1)
+    import matplotlib.pyplot as plt  # only needed when the counts change
+    with plt.rc_context({'font.size': 9.0}):
+        fig1, ax1 = plt.subplots(figsize=(1, 1))
+        ax1.pie(sizes, explode=explode, labels=labels, colors=colors, autopct='%1.0f%%',
+                shadow=True, startangle=90)
+        ax1.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
+        buf = io.BytesIO()
+        fig1.savefig(buf, format='png', dpi=200, bbox_inches='tight')
+    plt.close(fig1)
+    return buf.getvalue()
+
+
+def plot_pie_chart(cluster_index):
+    summary = cluster_index.summary()
+    st.image(pie_chart_png(summary['clusters_started'], summary['clusters'] - summary['clusters_started']),
+             use_column_width=True)
+
+
+def progress_overview(rec_names):
+    # One row per recorder from the cluster indexes; sheets are served from the shared records cache
+    rows = {}
+    for rec_name in rec_names:
+        summary = get_cluster_index(rec_name, get_sheets().records("XP_final_annotations", rec_name)).summary()
+        rows[rec_name] = {
+            'Clusters': summary['clusters'],
+            'Clusters done': summary['clusters_done'],
+            'ROIs': summary['rois'],
+            'ROIs annotated': summary['rois_annotated'],
+            'Progress': f"{summary['rois_annotated'] / max(summary['rois'], 1):.0%}",
+        }
+    st.dataframe(pd.DataFrame.from_dict(rows, orient='index'))
+
+
+def save_annotations(rec_name, annotations_df, csv_file, cluster_index, annotations):
+    with annotation_lock(rec_name):
+        # Update the annotations_df DataFrame with new annotations
+        changed_files = apply_annotations(annotations_df, annotations)
+        annotations_df['validated_class'] = annotations_df['validated_class'].astype(str)
+
+        # Save to CSV file
+        save_local_changes(csv_file, annotations_df, changed_files,
+                           compact_every=int(setting("csv_compact_rows", 5000)))
+
+        # Count the submitted ROIs as annotated
+        cluster_index.update(annotations_df, [annotation['file_name'] for annotation in annotations])
+
+    # Commit locally; the sync worker pushes the batch to the Google Sheet
+    get_local_store().commit(rec_name, [annotation for annotation in annotations
+                                        if annotation['file_name'] in changed_files])
+    get_sync_worker().wake()
+    return changed_files
+
+
+def update_cluster_status(rec_name, clusters, cluster_index, user):
+    # After a submit: clusters with nothing left are done, the one this session works on stays in progress
+    service = get_status_service()
+    unannotated = cluster_index.unannotated_folders()
+    for cluster in clusters:
+        folder_key = status_key(rec_name, cluster)
+        if cluster not in unannotated:
+            service.set_status(folder_key, user, DONE)
+            if st.session_state.get('claimed_folder') == folder_key:
+                st.session_state.pop('claimed_folder', None)
+        elif st.session_state.get('claimed_folder') == folder_key:
+            service.set_status(folder_key, user, IN_PROGRESS)
+    service.flush()
+
+
+def similar_rois(rec_name, annotations_df, csv_file, cluster_index, feature_index, folder, file_names, bundle, cmap,
+                 user):
+    # Pick example ROIs from this subfolder, pull up the closest ROIs of the whole recorder and label them in one submit.
+    # ROIs of clusters claimed by other annotators are left out.
+    def claimed_files():
+        claimed = get_status_service().claimed_by_others(user)
+        return cluster_index.cluster_files([cluster for cluster in cluster_index.files
+                                            if status_key(rec_name, cluster) in claimed])
+
+    with st.expander("**:violet[Find similar ROIs and label them together]**"):
+        examples = st.multiselect("Example ROIs from this subfolder", [f for f in file_names if f in feature_index],
+                                  key=f"similar_examples_{rec_name}")
+        col1, col2 = st.columns(2)
+        with col1:
+            k = st.number_input("Number of similar ROIs", min_value=1, max_value=500, value=20)
+        with col2:
+            only_unannotated = st.checkbox("Only unannotated ROIs", value=True)
+        if not examples:
+            if not len(feature_index):
+                st.info("No acoustic features for this recorder yet: run prerender.py, or open subfolders to index them.")
+            return
+
+        with perf.span('feature_query'):
+            matches = feature_index.nearest(examples, k=int(k),
+                                            allowed=cluster_index.unannotated_files() if only_unannotated else None,
+                                            excluded=claimed_files())
+        if not matches:
+            st.info("No similar ROIs found.")
+            return
+        matched_files = [filename for (_, _, filename), _ in matches]
+        table = pd.DataFrame([{'ROI': filename, 'Cluster': cluster, 'Period': period, 'Similarity': round(score, 3)}
+                              for (cluster, period, filename), score in matches])
+        with annotation_lock(rec_name):
+            suggested = lookup_suggestions(annotations_df, matched_files, ['suggested_class'])
+            suggestion = lookup_suggestions(annotations_df, examples[:1]).iloc[0]
+        table['Suggested group'] = suggested.values[:, 0]
+        st.dataframe(table, hide_index=True)
+        if bundle is not None:
+            shown = matches[:int(setting("similar_previews", 12))]
+            st.image([bundle.png(cluster, period, filename, cmap, cache=get_spec_cache())
+                      for (cluster, period, filename), _ in shown],
+                     caption=[filename for (_, _, filename), _ in shown], width=200)
+
+        with st.form(key="bulk_label_form"):
+            selected = st.multiselect("ROIs to label", matched_files, default=matched_files)
+            include_examples = st.checkbox("Also label the example ROIs", value=True)
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                group_input = st.text_input("Group", value=suggestion['suggested_class'])
+            with col2:
+                scientific_name_input = st.text_input("Species", value=suggestion['suggested_label'])
+            with col3:
+                validator_name_input = st.text_input("Validator", value=suggestion['validator_name'])
+            with col4:
+                comment_input = st.text_input("Comment", value=suggestion['comment'])
+            labelButton = st.form_submit_button(label="Label selected ROIs")
+
+        if labelButton:
+            targets = selected + [f for f in examples if include_examples and f not in selected]
+            # A cluster may have been claimed since the matches were listed
+            blocked = claimed_files()
+            skipped = [f for f in targets if f in blocked]
+            targets = [f for f in targets if f not in blocked]
+            clusters = {cluster for (cluster, _, filename), _ in matches if filename in targets}
+            if any(f in targets for f in examples):
+                clusters.add(folder)
+            annotations = [{
+                'file_name': file_name,
+                'group_input': group_input,
+                'scientific_name_input': scientific_name_input,
+                'validator_name_input': validator_name_input,
+                'comment_input': comment_input,
+            } for file_name in targets]
+            with st.spinner('Saving annotations...'):
+                save_annotations(rec_name, annotations_df, csv_file, cluster_index, annotations)
+                update_cluster_status(rec_name, sorted(clusters), cluster_index, user)
+            st.success(f"{len(targets)} ROIs have been labelled and saved locally; they are written to the "
+                       f"Google Sheet in the background.")
+            if skipped:
+                st.warning(f"{len(skipped)} ROIs were skipped: their cluster was claimed by another annotator.")
+            st.experimental_rerun()
+
+
+def perf_panel(record):
+    # Sidebar breakdown of the rerun that just finished, plus rolling p50/p95 across reruns
+    stats = perf.percentiles()
+    with st.sidebar:
+        st.subheader("Performance")
+        st.write(f"This rerun: {record['total'] * 1000:.0f} ms")
+        spans = pd.DataFrame({
+            'ms': {name: seconds * 1000 for name, seconds in record['spans'].items()},
+            'calls': record['calls'],
+            'p50 ms': {name: stats[name]['p50'] * 1000 for name in record['spans'] if name in stats},
+            'p95 ms': {name: stats[name]['p95'] * 1000 for name in record['spans'] if name in stats},
+        }).sort_values('ms', ascending=False)
+        st.dataframe(spans.round(1))
+        if record['counters']:
+            st.dataframe(pd.Series(record['counters'], name='count'))
+        st.caption(f"{get_local_store().pending_count()} annotations waiting to sync")
+
+
+def sync_status():
+    # Submits are saved locally first: say so while the sheet is behind, and loudly when pushes fail
+    pending, failed = get_local_store().sync_counts()
+    if failed:
+        st.warning(f"{failed} saved annotations could not be written to the Google Sheet yet, retrying. "
+                   f"They are kept on this server until then.")
+    elif pending:
+        st.caption(f"{pending} saved annotations are waiting to be written to the Google Sheet.")
 
 
 def iden():
-    # Set up the credentials and client
+    # Started with the page, so edits left pending by an earlier server process are pushed without waiting for a submit
+    get_sync_worker()
+    perf.begin_run('Identification', session=st.session_state.get('useremail'))
+    try:
+        annotation_page()
+    finally:
+        record = perf.end_run()
+    if setting("perf_panel", False):
+        perf_panel(record)
+
+
+def annotation_page():
     st.markdown('#####')
     st.header("Bamscape Clusters Annotator")
-    client = authorize_google_sheets()
+    sync_status()
 
     # Select a recorder to analyze
-    rec_name = st.selectbox('**:violet[Please, select a recorder to analyze]**',
-                            options=['rec1dmu', 'rec3dmu', 'rec3dmu_v2', 'rec4dmu', 'rec4dmu_v2', 'rec6dmu', 'rec7dmu'])
+    rec_name = st.selectbox('**:violet[Please, select a recorder to analyze]**', options=REC_NAMES)
+
+    if st.checkbox("Show progress for all recorders"):
+        progress_overview(REC_NAMES)
 
     if rec_name:
         # Load the CSV files and Google Sheets
-        sheet = client.open("XP_final_annotations").worksheet(f"{rec_name}")
-        final_annotations = pd.DataFrame(sheet.get_all_records())
+        records = get_sheets().records("XP_final_annotations", rec_name)
+        final_annotations = load_annotations(rec_name, records)
         st.session_state.final_annotations = final_annotations
         annotations_df = st.session_state.final_annotations
         csv_file = f'{rec_name}_all_CLUSTERS_COMBINED.csv'
+        cluster_index = get_cluster_index(rec_name, records, annotations_df)
 
         # Display the pie chart
-        plot_pie_chart(annotations_df)
-
-        # Filter out the annotated rows based on specific columns
-        unannotated_df = annotations_df[(annotations_df['validated_class'] == 0) |
-                                        (annotations_df['validated_specie'] == 0) |
-                                        (annotations_df['validator_name'] == 0)]
-
-        # Load the initial state from the Google Sheet
-        if 'folders' not in st.session_state:
-            folders = unannotated_df['cluster_number'].astype(str).unique()
-            st.session_state.folders = {
-                folder: unannotated_df[unannotated_df['cluster_number'] == int(folder)]['period'].astype(
-                    str).unique().tolist() for folder in folders}
-
-        # Get current annotation status
-        annotation_status = get_annotation_status()
-
-        # Check if user has previously uploaded files for the selected rec_name and store in session state
-        if 'uploaded_files' not in st.session_state:
-            st.session_state.uploaded_files = {}
-
-        # Allow the user to upload a ZIP file
-        uploaded_files = st.file_uploader(f"**:violet[Upload a ZIP file containing Clusters folders of {rec_name}]**", type=["zip"], accept_multiple_files=True)
-
-        if uploaded_files:
-            # Create a temporary directory to extract the ZIP file
-            with tempfile.TemporaryDirectory() as tmpdir:
-                for uploaded_file in uploaded_files:
-                    with zipfile.ZipFile(uploaded_file, 'r') as zip_ref:
-                        zip_ref.extractall(tmpdir)
-
-                st.success(f"Clusters folders extracted successfully")
-
-                # Log the extracted files and directories
-                for root, dirs, files in os.walk(tmpdir):
-                    logger.debug(f"Extracted root: {root}")
-                    logger.debug(f"Extracted dirs: {dirs}")
-                    logger.debug(f"Extracted files: {files}")
-
-                # Use the extracted directory as the base path
-                base_path = tmpdir
-
-                col1, col2, col3 = st.columns(3)
-                selected_folder = None
-                selected_subfolder = None
-                with st.container():
-                    with col1:
-                        if st.session_state.folders:
-                            selected_folder = st.selectbox("**:violet[Select a cluster folder to analyze]**",
-                                                           list(st.session_state.folders.keys()))
-                            logger.debug(f"Selected folder: {selected_folder}")
+        plot_pie_chart(cluster_index)
+
+        # Clusters and periods that still have unannotated ROIs
+        folders = cluster_index.unannotated_folders()
+
+        # Hide clusters other annotators are working on (served from the cached status table)
+        user = st.session_state.get('useremail', '')
+        claimed_elsewhere = get_status_service().claimed_by_others(user)
+        available_folders = {folder: subfolders for folder, subfolders in folders.items()
+                             if status_key(rec_name, folder) not in claimed_elsewhere}
+
+        # A pre-rendered bundle replaces the ZIP upload for this recorder
+        bundle = get_bundle(rec_name)
+        if bundle is None:
+            # Check if user has previously uploaded files for the selected rec_name and store in session state
+            if 'uploaded_files' not in st.session_state:
+                st.session_state.uploaded_files = {}
+
+            # Allow the user to upload a ZIP file
+            uploaded_files = st.file_uploader(f"**:violet[Upload a ZIP file containing Clusters folders of {rec_name}]**", type=["zip"], accept_multiple_files=True)
+
+            # Uploaded ZIPs are hashed and indexed once per session; subfolders are extracted on demand
+            upload_store = get_upload_store()
+            upload_store.sync(uploaded_files or [])
+            source = upload_store
+        else:
+            upload_store = None
+            source = bundle
+
+        if source:
+            if bundle is None:
+                st.success(f"Clusters folders indexed successfully")
+            else:
+                st.success(f"Pre-rendered clusters folders of {rec_name} loaded")
+
+            col1, col2, col3 = st.columns(3)
+            selected_folder = None
+            selected_subfolder = None
+            with st.container():
+                with col1:
+                    if available_folders:
+                        selected_folder = st.selectbox("**:violet[Select a cluster folder to analyze]**",
+                                                       list(available_folders.keys()))
+                        logger.debug(f"Selected folder: {selected_folder}")
+                        folder_key = status_key(rec_name, selected_folder)
+                        # Browsing doesn't claim a cluster; moving away from the one being annotated hands it back
+                        claimed_folder = st.session_state.get('claimed_folder')
+                        if claimed_folder and claimed_folder != folder_key:
+                            get_status_service().release(claimed_folder, user)
+                            get_status_service().flush()
+                            st.session_state.pop('claimed_folder', None)
+                    elif folders:
+                        st.info("All remaining clusters are being annotated by other users.")
+                    else:
+                        st.success("Congratulations, all the clusters have been annotated! Please select another recorder to annotate.")
+                with col2:
+                    if selected_folder:
+                        subfolders = folders[selected_folder]
+                        if subfolders:
+                            selected_subfolder = st.selectbox("**:violet[Select a subfolder to analyze]**", subfolders)
+                            logger.debug(f"Selected subfolder: {selected_subfolder}")
+                with col3:
+                    selected_cmap = st.selectbox("**:violet[Choose a colormap to display spectrograms]**",
+                                                 options=['jet', 'Greys', 'plasma', 'viridis', 'inferno'])
+
+            if selected_folder and selected_subfolder:
+                st.write(source.files(selected_folder, selected_subfolder))
+                st.markdown("---")
+
+                if bundle is not None:
+                    audio_files = bundle.files(selected_folder, selected_subfolder)
+                else:
+                    with st.spinner('Extracting...'):
+                        audio_files = upload_store.extract(selected_folder, selected_subfolder)
+                logger.debug(f"Audio files found: {len(audio_files)}")
+
+                if audio_files:
+                    file_names = [os.path.basename(f) for f in audio_files]
+                    with annotation_lock(rec_name):
+                        suggestions = lookup_suggestions(annotations_df, file_names)
+
+                    # Large subfolders are shown one page at a time; edits are kept in session state
+                    page_size = int(setting("form_page_size", 25))
+                    page_key = f"form_page_{rec_name}_{selected_folder}_{selected_subfolder}"
+                    n_pages, page, first, last = page_bounds(len(audio_files), page_size,
+                                                             st.session_state.get(page_key, 0))
+                    page_files = audio_files[first:last]
+                    edits = st.session_state.setdefault('form_edits', {})
+                    if n_pages > 1:
+                        st.markdown(f"**:violet[Page {page + 1} of {n_pages}]** (ROIs {first + 1}-{last} of "
+                                    f"{len(audio_files)})")
+
+                    if bundle is not None:
+                        # Slices of the mapped bundle: no extraction, no decode, no STFT, only the colormap
+                        clips = [bundle.clip(selected_folder, selected_subfolder, f) for f in page_files]
+                        spectrograms = [bundle.png(selected_folder, selected_subfolder, f, selected_cmap,
+                                                   cache=get_spec_cache()) for f in page_files]
+                    else:
+                        # Each ROI is read once: the bytes feed the player, the hash keys the spectrogram cache
+                        clips = [open_clip(f) for f in page_files]
+                        # Long ROIs show the overview of their tile pyramid instead of a full-resolution STFT
+                        short = [i for i, clip in enumerate(clips) if not is_long(clip)]
+                        with st.spinner('Processing...'):
+                            rendered = get_spec_renderer().render([page_files[i] for i in short], selected_cmap,
+                                                                  clips=[clips[i] for i in short])
+                            spectrograms = [None if i in short else pyramid_png(clip, selected_cmap)
+                                            for i, clip in enumerate(clips)]
+                            for i, png in zip(short, rendered):
+                                spectrograms[i] = png
+                        # Rendered ROIs become searchable for "find similar ROIs"
+                        feature_index = get_feature_index(rec_name)
+                        rendered = [(f, get_spec_renderer().spec(clip.digest))
+                                    for f, clip in zip(file_names[first:last], clips) if f not in feature_index]
+                        rendered = [(f, spec) for f, spec in rendered if spec is not None]
+                        if rendered:
+                            feature_index.add([(selected_folder, selected_subfolder, f) for f, _ in rendered],
+                                              [spec_descriptor(spec) for _, spec in rendered])
+
+                        # Warm the cache for the next page, or the next subfolder on the last page
+                        if last < len(audio_files):
+                            _, _, next_first, next_last = page_bounds(len(audio_files), page_size, page + 1)
+                            prefetch_rois(get_spec_renderer(), get_pyramid_store(), audio_files[next_first:next_last],
+                                          selected_cmap, tile_min_seconds())
                         else:
-                            st.success("Congratulations, all the clusters have been annotated! Please select another recorder to annotate.")
-                    with col2:
-                        if selected_folder:
-                            subfolders = st.session_state.folders[selected_folder]
-                            if subfolders:
-                                selected_subfolder = st.selectbox("**:violet[Select a subfolder to analyze]**", subfolders)
-                                logger.debug(f"Selected subfolder: {selected_subfolder}")
-                    with col3:
-                        selected_cmap = st.selectbox("**:violet[Choose a colormap to display spectrograms]**",
-                                                     options=['jet', 'Greys', 'plasma', 'viridis', 'inferno'])
-
-                if selected_folder and selected_subfolder:
-                    subfolder_path = os.path.join(base_path, selected_folder, selected_subfolder)
-                    logger.debug(f"Subfolder path: {subfolder_path}")
-
-                    for root, dirs, files in os.walk(subfolder_path, topdown=False):
-                        targetfolder = files
-                        logger.debug(f"Files in subfolder: {files}")
-                        st.write(targetfolder)
-                        st.markdown("---")
-
-                    audio_files = load_audio_files(subfolder_path)
-                    logger.debug(f"Audio files found: {audio_files}")
-
-                    if audio_files:
-                        form = st.form(key=f"user_form")
-                        annotations = []  # Initialize annotations list here
-                        with form:
-                            for i, audio_file in enumerate(audio_files):
-                                file_name = os.path.basename(audio_file)
-                                cols = [1.70, 1, 1, 1, 1, 1]
-                                col1, col2, col3, col4, col5, col6 = st.columns(cols)
-                                with col1:
-                                    with st.spinner('Processing...'):
-                                        st.markdown(
-                                            f"<h6 style='text-align: center; color: green;'>ROI: {file_name} </h10>",
+                            next_folder, next_sub = next_subfolder(available_folders, selected_folder,
+                                                                   selected_subfolder)
+                            if next_sub:
+                                prefetch_subfolder(upload_store, next_folder, next_sub, selected_cmap, page_size)
+
+                    form = st.form(key=f"user_form")
+                    annotations = []  # Initialize annotations list here
+                    with form:
+                        for i, audio_file in enumerate(page_files):
+                            file_name = os.path.basename(audio_file)
+                            suggestion = suggestions.iloc[first + i]
+                            edit = edits.get(file_name, {})
+                            cols = [1.70, 1, 1, 1, 1, 1]
+                            col1, col2, col3, col4, col5, col6 = st.columns(cols)
+                            with col1:
+                                st.markdown(
+                                    f"<h6 style='text-align: center; color: green;'>ROI: {file_name} </h10>",
+                                    unsafe_allow_html=True)
+                                st.image(spectrograms[i])
+                            with col2:
+                                st.markdown(f"<h2 style='text-align: center; color: black;'></h10>",
                                             unsafe_allow_html=True)
-                                        plot_spec(audio_file, cmap=selected_cmap)
-                                with col2:
-                                    st.markdown(f"<h2 style='text-align: center; color: black;'></h10>",
-                                                unsafe_allow_html=True)
-                                    st.markdown('######')
-                                    audio_data, audio_sr = sf.read(audio_file)
-                                    st.audio(audio_data, format='audio/wav', sample_rate=audio_sr, )
-                                with col3:
-                                    st.markdown('#####')
-                                    st.markdown(f"<h4 style='text-align: center; color: blue;'>Group</h5>",
-                                                unsafe_allow_html=True)
-                                    suggested_group = annotations_df.loc[
-                                        annotations_df['filename_ts'] == file_name, 'suggested_class'].values[0]
-                                    group_input = st.text_input(f"*(modify the text if needed)*", value=suggested_group,
-                                                                key=f"group_{file_name}")
-                                with col4:
-                                    st.markdown('#####')
-                                    st.markdown(f"<h4 style='text-align: center; color: blue;'>Species</h5>",
-                                                unsafe_allow_html=True)
-                                    suggested_label = annotations_df.loc[
-                                        annotations_df['filename_ts'] == file_name, 'suggested_label'].values[0]
-                                    scientific_name_input = st.text_input("*(modify the text if needed)*",
-                                                                          value=suggested_label,
-                                                                          key=f"scientific_name_{file_name}")
-                                with col5:
-                                    st.markdown('#####')
-                                    st.markdown(f"<h4 style='text-align: center; color: blue;'>Validator</h5>",
-                                                unsafe_allow_html=True)
-                                    validator_name = annotations_df.loc[
-                                        annotations_df['filename_ts'] == file_name, 'validator_name'].values[0]
-                                    validator_name_input = st.text_input("*(please, enter your name)*",
-                                                                         value=validator_name,
-                                                                         key=f"validator_name_{file_name}")
-                                with col6:
-                                    st.markdown('#####')
-                                    st.markdown(f"<h4 style='text-align: center; color: blue;'>Comment</h5>",
-                                                unsafe_allow_html=True)
-                                    comment = annotations_df.loc[
-                                        annotations_df['filename_ts'] == file_name, 'comment'].values[0]
-                                    comment_input = st.text_input("*(feel free to tell something)*", value=comment,
-                                                                  key=f"validator_comment_{file_name}")
-                                annotations.append({
-                                    'file_name': file_name,
-                                    'group_input': group_input,
-                                    'scientific_name_input': scientific_name_input,
-                                    'validator_name_input': validator_name_input,
-                                    'comment_input': comment_input
-                                })
-                            submitButton = form.form_submit_button(label="Submit annotations")
-                        if submitButton:
-                            with st.spinner('Saving annotations...'):
-                                for annotation in annotations:
-                                    file_name = annotation['file_name']
-                                    group_input = annotation['group_input']
-                                    scientific_name_input = annotation['scientific_name_input']
-                                    validator_name_input = annotation['validator_name_input']
-                                    comment_input = annotation['comment_input']
-                                    # Update the annotations_df DataFrame with new annotations
-                                    annotations_df.loc[
-                                        annotations_df['filename_ts'] == file_name, 'validated_class'] = group_input
-                                    annotations_df.loc[
-                                        annotations_df[
-                                            'filename_ts'] == file_name, 'validated_specie'] = scientific_name_input
-                                    annotations_df.loc[
-                                        annotations_df[
-                                            'filename_ts'] == file_name, 'validator_name'] = validator_name_input
-                                    annotations_df.loc[
-                                        annotations_df['filename_ts'] == file_name, 'comment'] = comment_input
-                                annotations_df['validated_class'] = annotations_df['validated_class'].astype(str)
-
-                                # Save to CSV file
-                                annotations_df.to_csv(csv_file, index=False)
-
-                                # Update the Google Sheet
-                                update_google_sheet(client, rec_name, annotations_df)
-
-                                st.success("All annotations have been saved.")
-
-                                # Remove the analyzed subfolder from the list
-                                st.session_state.folders[selected_folder].remove(selected_subfolder)
-
-                                # If no more subfolders in the main folder, remove the main folder as well
-                                if not st.session_state.folders[selected_folder]:
-                                    del st.session_state.folders[selected_folder]
-
-                                st.experimental_rerun()
-                    else:
-                        st.error("No audio files found in the selected subfolder.")
-
-                    spacing()
-
-                    # Display the DataFrame
-                    st.header("Annotated DataFrame")
-                    st.write(
-                        ":orange[Feel free to also access the dataframe on google sheet [link](https://docs.google.com/spreadsheets/d/119CGzxLv0kclMMb3SDYYwrULn2WY77OqDrzR6McEYO0/edit?gid=0#gid=0)]")
-                    df = get_google_sheet_data()
-                    df_display = df.astype(str)
-                    st.write(df_display)
-                    st.markdown('#####')
+                                st.markdown('######')
+                                st.audio(clips[i].data, format='audio/wav')
+                            with col3:
+                                st.markdown('#####')
+                                st.markdown(f"<h4 style='text-align: center; color: blue;'>Group</h5>",
+                                            unsafe_allow_html=True)
+                                suggested_group = edit.get('group_input', suggestion['suggested_class'])
+                                group_input = st.text_input(f"*(modify the text if needed)*", value=suggested_group,
+                                                            key=f"group_{file_name}")
+                            with col4:
+                                st.markdown('#####')
+                                st.markdown(f"<h4 style='text-align: center; color: blue;'>Species</h5>",
+                                            unsafe_allow_html=True)
+                                suggested_label = edit.get('scientific_name_input', suggestion['suggested_label'])
+                                scientific_name_input = st.text_input("*(modify the text if needed)*",
+                                                                      value=suggested_label,
+                                                                      key=f"scientific_name_{file_name}")
+                            with col5:
+                                st.markdown('#####')
+                                st.markdown(f"<h4 style='text-align: center; color: blue;'>Validator</h5>",
+                                            unsafe_allow_html=True)
+                                validator_name = edit.get('validator_name_input', suggestion['validator_name'])
+                                validator_name_input = st.text_input("*(please, enter your name)*",
+                                                                     value=validator_name,
+                                                                     key=f"validator_name_{file_name}")
+                            with col6:
+                                st.markdown('#####')
+                                st.markdown(f"<h4 style='text-align: center; color: blue;'>Comment</h5>",
+                                            unsafe_allow_html=True)
+                                comment = edit.get('comment_input', suggestion['comment'])
+                                comment_input = st.text_input("*(feel free to tell something)*", value=comment,
+                                                              key=f"validator_comment_{file_name}")
+                            annotations.append({
+                                'file_name': file_name,
+                                'group_input': group_input,
+                                'scientific_name_input': scientific_name_input,
+                                'validator_name_input': validator_name_input,
+                                'comment_input': comment_input
+                            })
+                        if n_pages > 1:
+                            nav1, nav2, _ = st.columns([1, 1, 4])
+                            with nav1:
+                                previousButton = form.form_submit_button(label="Previous page", disabled=page == 0)
+                            with nav2:
+                                nextButton = form.form_submit_button(label="Next page", disabled=page == n_pages - 1)
+                            st.caption("Only the ROIs of pages you have opened are submitted.")
+                        else:
+                            previousButton = nextButton = False
+                        submitButton = form.form_submit_button(label="Submit annotations")
+
+                    # Working on the cluster (paging through its form or submitting) is what claims it
+                    if (previousButton or nextButton or submitButton) and \
+                            st.session_state.get('claimed_folder') != folder_key:
+                        if not get_status_service().claim(folder_key, user):
+                            st.warning("This cluster was just claimed by another annotator, please select another one.")
+                            st.stop()
+                        st.session_state.claimed_folder = folder_key
+
+                    # Any form button sends the visible page: keep its values before moving or committing
+                    if previousButton or nextButton or submitButton:
+                        for annotation in annotations:
+                            edits[annotation['file_name']] = annotation
+                    if previousButton or nextButton:
+                        st.session_state[page_key] = page + (1 if nextButton else -1)
+                        st.experimental_rerun()
+                    if submitButton:
+                        # Commit the pages that were shown; ROIs on pages never opened stay unannotated
+                        annotations = [edits[file_name] for file_name in file_names if file_name in edits]
+                        with st.spinner('Saving annotations...'):
+                            # The analyzed subfolder drops out of the list once its ROIs count as annotated
+                            save_annotations(rec_name, annotations_df, csv_file, cluster_index, annotations)
+
+                            st.success(f"{len(annotations)} annotations have been saved locally; they are written "
+                                       f"to the Google Sheet in the background.")
+                            for annotation in annotations:
+                                edits.pop(annotation['file_name'], None)
+                            if len(annotations) == len(file_names):
+                                st.session_state.pop(page_key, None)
+
+                            # If no more subfolders in the main folder, mark the main folder as done
+                            update_cluster_status(rec_name, [selected_folder], cluster_index, user)
+
+                            st.experimental_rerun()
+
+                    zoom_long_rois(file_names[first:last], clips, selected_cmap)
+                    similar_rois(rec_name, annotations_df, csv_file, cluster_index, get_feature_index(rec_name, bundle),
+                                 selected_folder, file_names, bundle, selected_cmap, user)
+                else:
+                    st.error("No audio files found in the selected subfolder.")
+
+                spacing()
+
+                # Display the DataFrame
+                st.header("Annotated DataFrame")
+                st.write(
+                    ":orange[Feel free to also access the dataframe on google sheet [link](https://docs.google.com/spreadsheets/d/119CGzxLv0kclMMb3SDYYwrULn2WY77OqDrzR6McEYO0/edit?gid=0#gid=0)]")
+                df = get_google_sheet_data()
+                df_display = df.astype(str)
+                st.write(df_display)
+                st.markdown('#####')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+import hashlib
+import io
+
+import soundfile as sf
+
+import perf
+
+
+class AudioClip:
+    # One ROI read from disk exactly once.
+    # `data` holds the original WAV bytes, handed to st.audio as-is (no decode, no re-encode);
+    # duration and sample rate come from the header; samples are decoded lazily, once, as
+    # float32 and shared by everything that needs them (spectrograms, features).
+
+    def __init__(self, path, data, digest=None):
+        self.path = path
+        self.data = data
+        info = sf.info(io.BytesIO(data))
+        self.samplerate = info.samplerate
+        self.frames = info.frames
+        self.channels = info.channels
+        self._samples = None
+        self._digest = digest
+
+    @property
+    def duration(self):
+        return self.frames / self.samplerate
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.data).hexdigest()
+        return self._digest
+
+    @perf.timed('audio_decode')
+    def samples(self):
+        if self._samples is None:
+            s, _ = sf.read(io.BytesIO(self.data), dtype='float32')
+            if s.ndim > 1:
+                s = s[:, 0]  # left channel, as maad.sound.load does
+            s -= s.mean()  # same DC removal as maad.sound.load(detrend=True)
+            self._samples = s
+        return self._samples
+
+
+def clip_duration(path):
+    # Seconds of audio, from the WAV header only
+    return sf.info(path).duration
+
+
+@perf.timed('audio_read')
+def open_clip(path):
+    with open(path, 'rb') as f:
+        return AudioClip(path, f.read())
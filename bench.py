@@ -0,0 +1,459 @@
+"""Benchmarks for the annotator hot paths, run against synthetic data and an in-memory Sheets stand-in.
+
+    python bench.py --rows 1000 10000 100000 --output bench.json
+
+Results are written as JSON so runs can be compared over time.
+
+Cold-start import times are measured in fresh interpreters; with a budget set, the run fails
+(non-zero exit) when it is exceeded or when the Identification modules load the STFT stack:
+
+    python bench.py --imports-only --import-budget 1.5 --login-import-budget 2.0
+
+The same budgets are enforced by tests/test_import_budget.py (python -m pytest).
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from annotations import apply_annotations, index_annotations, lookup_suggestions, save_local_changes
+from audio import open_clip
+from bundle import SpectrogramBundle
+from fake_sheets import FakeClient
+from features import DESCRIPTOR_DIM, FeatureIndex
+from prerender import prerender
+from progress import ClusterIndex
+from local_store import LocalAnnotationStore, SyncWorker
+from sheets import SheetsCache, write_full_sheet
+from spectrogram import SpectrogramCache, SpectrogramRenderer, colorize, compute_spec
+from status import DONE, IN_PROGRESS, AnnotationStatus, STATUS_COLUMNS, status_key
+from tiles import PyramidStore
+from uploads import UploadStore
+
+REC_NAME = 'rec_bench'
+COLUMNS = ['filename_ts', 'cluster_number', 'period', 'suggested_class', 'suggested_label',
+           'validated_class', 'validated_specie', 'validator_name', 'comment']
+
+
+# What main.py needs to paint the login screen, and what the Identification page adds on top
+LOGIN_MODULES = ['streamlit', 'streamlit_option_menu', 'pyrebase']
+IDENTIFICATION_MODULES = ['pandas', 'gspread', 'google.oauth2.service_account', 'perf', 'annotations', 'sheets',
+                          'status', 'uploads', 'audio', 'spectrogram', 'bundle', 'progress', 'local_store',
+                          'fake_sheets', 'features', 'tiles']
+# Only imported where a spectrogram is actually computed (the render pool workers, prerender.py)
+COMPUTE_MODULES = ['maad.sound', 'maad.util', 'skimage.transform']
+
+_IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+for module in sys.argv[2:]:
+    __import__(module)
+print(json.dumps({'seconds': time.perf_counter() - start,
+                  'compute_loaded': [m for m in json.loads(sys.argv[1]) if m in sys.modules]}))
+"""
+
+
+def import_time(modules, repeat=3):
+    # Cold import of `modules` in a fresh interpreter, best of `repeat`
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', _IMPORT_PROBE, json.dumps(COMPUTE_MODULES), *modules],
+                                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode:
+            return {'modules': modules, 'error': result.stderr.strip().splitlines()[-1]}
+        measured = json.loads(result.stdout)
+        if best is None or measured['seconds'] < best['seconds']:
+            best = measured
+    return dict(best, modules=modules)
+
+
+def import_report():
+    return {'login': import_time(LOGIN_MODULES),
+            'identification': import_time(IDENTIFICATION_MODULES),
+            'compute': import_time(COMPUTE_MODULES)}
+
+
+def import_violations(report, budgets):
+    # Budget failures as messages; a stage that could not be imported at all counts as one
+    violations = []
+    for stage, budget in budgets.items():
+        measured = report[stage]
+        if 'error' in measured:
+            violations.append(f"{stage} imports failed: {measured['error']}")
+        elif measured['seconds'] > budget:
+            violations.append(f"{stage} imports took {measured['seconds']:.2f}s, budget is {budget:.2f}s")
+    loaded = report['identification'].get('compute_loaded')
+    if budgets and loaded:
+        violations.append(f"Identification imports load the STFT stack: {', '.join(loaded)}")
+    return violations
+
+
+def make_cluster_zip(path, clusters=3, periods=2, wavs=10, duration=3.0, samplerate=48000, seed=0):
+    # Synthetic cluster archive laid out as <cluster>/<period>/<ROI>.WAV; returns (cluster, period, file) entries
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * samplerate)) / samplerate
+    entries = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for c in range(clusters):
+            for p in range(periods):
+                period = f"{p:02d}h"
+                for w in range(wavs):
+                    name = f"S4A_{c:03d}_{p:02d}_{w:04d}.WAV"
+                    freq = rng.uniform(1000, samplerate / 4)
+                    s = 0.3 * np.sin(2 * np.pi * freq * t) + 0.02 * rng.standard_normal(len(t))
+                    buf = io.BytesIO()
+                    sf.write(buf, s.astype(np.float32), samplerate, format='WAV', subtype='PCM_16')
+                    zf.writestr(f"{c}/{period}/{name}", buf.getvalue())
+                    entries.append((str(c), period, name))
+    return entries
+
+
+def make_long_wav(path, duration=120.0, samplerate=48000, seed=0):
+    # One long ROI: background noise with a short chirp every few seconds
+    rng = np.random.default_rng(seed)
+    with sf.SoundFile(path, 'w', samplerate, 1, subtype='PCM_16') as f:
+        for start in range(0, int(duration * samplerate), 10 * samplerate):
+            n = min(10 * samplerate, int(duration * samplerate) - start)
+            s = 0.02 * rng.standard_normal(n)
+            t = np.arange(samplerate * 3 // 10) / samplerate
+            s[:len(t)] += 0.3 * np.sin(2 * np.pi * (3000 + 4000 * t / t[-1]) * t)
+            f.write(s.astype(np.float32))
+
+
+def make_records(entries, rows, seed=0):
+    # XP_final_annotations rows: the ROIs in the archive plus unannotated filler rows up to `rows`
+    rng = np.random.default_rng(seed)
+    records = [[name, int(cluster), period, 'bird', 'sp. A', 0, 0, 0, ''] for cluster, period, name in entries]
+    n_clusters = max(int(cluster) for cluster, _, _ in entries) + 1
+    for i in range(len(records), rows):
+        cluster = int(rng.integers(n_clusters, n_clusters + max(rows // 100, 1)))
+        records.append([f"FILL_{i:07d}.WAV", cluster, f"{i % 24:02d}h", 'insect', 'sp. B', 0, 0, 0, ''])
+    order = rng.permutation(len(records))
+    return [COLUMNS] + [records[i] for i in order]
+
+
+class Upload(io.BytesIO):
+    # Minimal stand-in for Streamlit's UploadedFile
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+        self.file_id = name
+
+
+class Timer:
+
+    def __init__(self):
+        self.spans = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - start
+
+
+def legacy_folders(annotations_df):
+    # The per-cluster boolean scans iden() used to build its folder map before the cluster index
+    unannotated_df = annotations_df[(annotations_df['validated_class'] == 0) |
+                                    (annotations_df['validated_specie'] == 0) |
+                                    (annotations_df['validator_name'] == 0)]
+    folders = unannotated_df['cluster_number'].astype(str).unique()
+    return {folder: unannotated_df[unannotated_df['cluster_number'] == int(folder)]['period'].astype(
+        str).unique().tolist() for folder in folders}
+
+
+def legacy_lookup(annotations_df, file_names):
+    # The per-field boolean scans iden() used before the indexed lookup
+    out = []
+    for file_name in file_names:
+        out.append([annotations_df.loc[annotations_df['filename_ts'] == file_name, field].values[0]
+                    for field in ['suggested_class', 'suggested_label', 'validator_name', 'comment']])
+    return out
+
+
+class Bench:
+
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.zip_path = os.path.join(workdir, 'clusters.zip')
+        self.entries = make_cluster_zip(self.zip_path, args.clusters, args.periods, args.wavs,
+                                        args.duration, args.samplerate)
+        with open(self.zip_path, 'rb') as f:
+            self.zip_bytes = f.read()
+        # Start the process pool up front so spawn time isn't charged to the first scenario
+        self.renderer = SpectrogramRenderer(SpectrogramCache(), workers=args.workers)
+        store = UploadStore()
+        store.sync([Upload(self.zip_bytes, 'clusters.zip')])
+        self.renderer.render(store.extract(*self.entries[0][:2]), 'jet')
+        store.close()
+        self.bundle = SpectrogramBundle(prerender(REC_NAME, [self.zip_path], workdir, workers=args.workers))
+        self.local_store = LocalAnnotationStore(os.path.join(workdir, 'annotations.sqlite3'))
+        self.long_path = os.path.join(workdir, 'long.WAV')
+        make_long_wav(self.long_path, args.long_duration, args.samplerate)
+
+    def fresh(self, rows):
+        # New fake backend, caches and upload store: the state of a server that just started
+        client = FakeClient(latency=self.args.latency)
+        client.add_worksheet("XP_final_annotations", REC_NAME, make_records(self.entries, rows))
+        n_status = max(rows // 50, 1)
+        status_rows = [STATUS_COLUMNS] + [[f"rec_other/{i}", 'someone', DONE, '2024-01-01 00:00:00']
+                                          for i in range(n_status)]
+        client.add_worksheet("XP_annotation_status", "status", status_rows)
+        sheets = SheetsCache(lambda: client, ttl=60)
+        self.renderer.cache = SpectrogramCache()
+        self.renderer.spec_cache = SpectrogramCache(suffix='.spec')
+        return client, sheets
+
+    def first_load(self, rows):
+        client, sheets = self.fresh(rows)
+        timer = Timer()
+        with timer.span('sheet_read'):
+            records = sheets.records("XP_final_annotations", REC_NAME)
+        with timer.span('index'):
+            annotations_df = index_annotations(records)
+        with timer.span('cluster_index'):
+            cluster_index = ClusterIndex(annotations_df, source=records)
+            cluster_index.unannotated_folders()
+            cluster_index.summary()
+        with timer.span('folders_legacy'):
+            legacy_folders(annotations_df)
+        store = UploadStore()
+        with timer.span('zip_index'):
+            store.sync([Upload(self.zip_bytes, 'clusters.zip')])
+        cluster, period = store.clusters()[0], store.periods(store.clusters()[0])[0]
+        with timer.span('zip_extract'):
+            audio_files = store.extract(cluster, period)
+        with timer.span('audio_read'):
+            clips = [open_clip(f) for f in audio_files]
+        with timer.span('spectrogram_render'):
+            self.renderer.render(audio_files, 'jet', clips=clips)
+        with timer.span('lookup'):
+            lookup_suggestions(annotations_df, [os.path.basename(f) for f in audio_files])
+        with timer.span('rerun_sheet_read'):
+            sheets.records("XP_final_annotations", REC_NAME)
+        state = dict(client=client, sheets=sheets, store=store, annotations_df=annotations_df,
+                     cluster_index=cluster_index, audio_files=audio_files, clips=clips)
+        return timer.spans, dict(client.calls), state
+
+    def colormap_change(self, state):
+        client = state['client']
+        client.reset_calls()
+        timer = Timer()
+        with timer.span('spectrogram_recolor'):
+            self.renderer.render(state['audio_files'], 'viridis', clips=state['clips'])
+        with timer.span('spectrogram_cached'):
+            self.renderer.render(state['audio_files'], 'viridis', clips=state['clips'])
+        return timer.spans, dict(client.calls)
+
+    def bundle_open(self, state):
+        # The same subfolder first_load extracted and rendered, served from the pre-rendered bundle
+        cluster, period = state['store'].clusters()[0], state['store'].periods(state['store'].clusters()[0])[0]
+        cache = SpectrogramCache()
+        timer = Timer()
+        with timer.span('bundle_open'):
+            file_names = self.bundle.files(cluster, period)
+            [self.bundle.clip(cluster, period, file_name) for file_name in file_names]
+            [self.bundle.png(cluster, period, file_name, 'jet', cache=cache) for file_name in file_names]
+        return timer.spans, {}
+
+    def similar(self, state):
+        # "Find similar ROIs" over one descriptor per annotation row, restricted to unannotated ROIs
+        annotations_df = state['annotations_df']
+        rng = np.random.default_rng(0)
+        matrix = rng.standard_normal((len(annotations_df), DESCRIPTOR_DIM)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        keys = list(zip(annotations_df['cluster_number'].astype(str), annotations_df['period'].astype(str),
+                        annotations_df.index))
+        timer = Timer()
+        with timer.span('feature_index'):
+            index = FeatureIndex(matrix, keys)
+        examples = [os.path.basename(f) for f in state['audio_files'][:3]]
+        with timer.span('feature_query'):
+            index.nearest(examples, k=50)
+        with timer.span('feature_query_unannotated'):
+            index.nearest(examples, k=50, allowed=state['cluster_index'].unannotated_files())
+        return timer.spans, {}
+
+    def long_roi(self, state):
+        # A long ROI opened through its tile pyramid (build, overview, 10s zoom) vs one full-resolution STFT
+        clip = open_clip(self.long_path)
+        store = PyramidStore(tempfile.mkdtemp(prefix="tiles_", dir=self.workdir))
+        timer = Timer()
+        with timer.span('pyramid_build'):
+            pyramid = store.get(clip.digest, self.long_path)
+        with timer.span('pyramid_overview'):
+            colorize(pyramid.view(), 'jet', size=(900, 300))
+        with timer.span('pyramid_zoom'):
+            colorize(pyramid.view(pyramid.duration / 2, pyramid.duration / 2 + 10), 'jet', size=(900, 300))
+        with timer.span('full_spec'):
+            colorize(compute_spec(clip.samples(), clip.samplerate), 'jet')
+        return timer.spans, {}
+
+    def lookup(self, state):
+        timer = Timer()
+        file_names = [os.path.basename(f) for f in state['audio_files']]
+        with timer.span('lookup_indexed'):
+            lookup_suggestions(state['annotations_df'], file_names)
+        with timer.span('lookup_legacy'):
+            legacy_lookup(state['annotations_df'], file_names)
+        return timer.spans, {}
+
+    def form_submit(self, state):
+        # What annotator.save_annotations does on submit, then the sync worker's push of that batch
+        client, sheets = state['client'], state['sheets']
+        annotations_df = state['annotations_df']
+        annotations = [{'file_name': os.path.basename(f), 'group_input': 'bird', 'scientific_name_input': 'sp. C',
+                        'validator_name_input': 'bench', 'comment_input': ''} for f in state['audio_files']]
+        csv_file = os.path.join(self.workdir, f"{REC_NAME}_all_CLUSTERS_COMBINED.csv")
+        if os.path.exists(csv_file):
+            os.remove(csv_file)
+        save_local_changes(csv_file, annotations_df, [])
+        client.reset_calls()
+        timer = Timer()
+        with timer.span('apply'):
+            changed = apply_annotations(annotations_df, annotations)
+            annotations_df['validated_class'] = annotations_df['validated_class'].astype(str)
+        with timer.span('index_update'):
+            state['cluster_index'].update(annotations_df, [a['file_name'] for a in annotations])
+        with timer.span('csv_write'):
+            save_local_changes(csv_file, annotations_df, changed)
+        with timer.span('local_commit'):
+            self.local_store.commit(REC_NAME, [a for a in annotations if a['file_name'] in changed])
+        # Woken explicitly below rather than on its timer
+        worker = SyncWorker(self.local_store, sheets, interval=3600)
+        with timer.span('sync'):
+            worker.sync_once()
+        worker.stop()
+        calls = dict(client.calls)
+        with timer.span('legacy_csv_write'):
+            annotations_df.to_csv(csv_file, index=False)
+        client.reset_calls()
+        with timer.span('legacy_sheet_write'):
+            write_full_sheet(sheets, "XP_final_annotations", REC_NAME, annotations_df)
+        calls.update({f"legacy_{k}": v for k, v in client.calls.items()})
+        return timer.spans, calls
+
+    def status_update(self, state):
+        client, sheets = state['client'], state['sheets']
+        service = AnnotationStatus(sheets, ttl=30)
+        folder = status_key(REC_NAME, state['store'].clusters()[0])
+        client.reset_calls()
+        timer = Timer()
+        with timer.span('status_read'):
+            service.claimed_by_others('bench')
+        with timer.span('status_reread_cached'):
+            service.claimed_by_others('bench')
+        with timer.span('claim'):
+            service.claim(folder, 'bench')
+        with timer.span('update'):
+            service.set_status(folder, 'bench', IN_PROGRESS)
+            service.flush()
+        calls = dict(client.calls)
+        # What update_annotation_status used to do: full read, then three single-cell writes
+        client.reset_calls()
+        worksheet = client.open("XP_annotation_status").worksheet("status")
+        with timer.span('legacy_update'):
+            df = pd.DataFrame(worksheet.get_all_records())
+            idx = df[df['cluster_folder'] == folder].index
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            worksheet.update_cell(idx[0] + 2, 2, 'bench')
+            worksheet.update_cell(idx[0] + 2, 3, DONE)
+            worksheet.update_cell(idx[0] + 2, 4, now)
+        calls.update({f"legacy_{k}": v for k, v in client.calls.items()})
+        return timer.spans, calls
+
+    def run(self):
+        results = []
+        for rows in self.args.rows:
+            for repeat in range(self.args.repeat):
+                spans, calls, state = self.first_load(rows)
+                results.append(dict(scenario='first_load', rows=rows, repeat=repeat, seconds=spans, api_calls=calls))
+                for scenario in (self.colormap_change, self.bundle_open, self.similar, self.long_roi, self.lookup, self.form_submit, self.status_update):
+                    spans, calls = scenario(state)
+                    results.append(dict(scenario=scenario.__name__, rows=rows, repeat=repeat, seconds=spans,
+                                        api_calls=calls))
+                state['store'].close()
+        self.renderer.shutdown()
+        return results
+
+
+def summarize(results):
+    # Median of each span over repeats, per scenario and row count
+    summary = {}
+    for result in results:
+        key = f"{result['scenario']}@{result['rows']}"
+        for span, seconds in result['seconds'].items():
+            summary.setdefault(key, {}).setdefault(span, []).append(seconds)
+    return {key: {span: statistics.median(values) for span, values in spans.items()}
+            for key, spans in summary.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="annotation row counts to run every scenario at")
+    parser.add_argument('--clusters', type=int, default=3)
+    parser.add_argument('--periods', type=int, default=2)
+    parser.add_argument('--wavs', type=int, default=10, help="WAV files per period subfolder")
+    parser.add_argument('--duration', type=float, default=3.0, help="seconds per WAV")
+    parser.add_argument('--samplerate', type=int, default=48000)
+    parser.add_argument('--long-duration', type=float, default=120.0, help="seconds of the long ROI")
+    parser.add_argument('--workers', type=int, default=None, help="spectrogram process pool size")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated seconds per Sheets API call")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--imports-only', action='store_true', help="only measure cold-start import times")
+    parser.add_argument('--import-budget', type=float,
+                        help="fail if the Identification page's imports take longer than this many seconds")
+    parser.add_argument('--login-import-budget', type=float,
+                        help="fail if the login screen's imports take longer than this many seconds")
+    args = parser.parse_args(argv)
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': vars(args),
+        'imports': import_report(),
+    }
+    if not args.imports_only:
+        workdir = tempfile.mkdtemp(prefix="annotator_bench_")
+        try:
+            results = Bench(args, workdir).run()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        report.update(summary=summarize(results), results=results)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    budgets = {stage: budget for stage, budget in (('identification', args.import_budget),
+                                                   ('login', args.login_import_budget)) if budget is not None}
+    violations = import_violations(report['imports'], budgets)
+    if violations:
+        sys.exit("Import budget exceeded:\n" + "\n".join(violations))
+
+
+if __name__ == '__main__':
+    main()
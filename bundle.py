@@ -0,0 +1,197 @@
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+from audio import AudioClip
+from features import DESCRIPTOR_DIM, spec_descriptor
+from spectrogram import DB_RANGE, NOVERLAP, NPERSEG, SpecImage, colorize, spec_key
+
+logger = logging.getLogger(__name__)
+
+# File layout: header (magic, manifest length), JSON manifest, padding to ALIGN, then the
+# uint8 dB levels of every ROI back to back, then the original audio bytes back to back, then
+# (padded to 16 bytes) one float32 feature descriptor per ROI as a single row-major matrix.
+# Entries are written in cluster/period/filename order, so a subfolder is one contiguous slice.
+MAGIC = b'ANNBNDL1'
+_HEADER = struct.Struct('<8sQ')
+ALIGN = 4096
+BUNDLE_VERSION = 2
+
+
+def bundle_path(bundle_dir, rec_name):
+    return os.path.join(bundle_dir, f"{rec_name}.bundle")
+
+
+def _data_start(manifest_size):
+    return -(-(_HEADER.size + manifest_size) // ALIGN) * ALIGN
+
+
+def _features_offset(levels_bytes, audio_bytes):
+    return -(-(levels_bytes + audio_bytes) // 16) * 16
+
+
+class BundleWriter:
+    # Streams entries into two scratch files, then assembles the bundle and moves it into place
+    # atomically, so the app never maps a half-written file.
+
+    def __init__(self, path, rec_name, nperseg=NPERSEG, noverlap=NOVERLAP, db_range=DB_RANGE):
+        self.path = path
+        self.manifest = {'version': BUNDLE_VERSION, 'rec_name': rec_name,
+                         'params': {'nperseg': nperseg, 'noverlap': noverlap, 'db_range': db_range},
+                         'levels_bytes': 0, 'audio_bytes': 0, 'clusters': {}}
+        self._scratch = tempfile.mkdtemp(prefix="annotator_bundle_", dir=os.path.dirname(os.path.abspath(path)))
+        self._levels = open(os.path.join(self._scratch, 'levels'), 'wb')
+        self._audio = open(os.path.join(self._scratch, 'audio'), 'wb')
+        self._features = []
+
+    def add(self, cluster, period, filename, clip, spec):
+        levels = np.ascontiguousarray(spec.levels, dtype=np.uint8)
+        entry = {
+            'levels': [self.manifest['levels_bytes'], *levels.shape],
+            'ext': list(spec.ext),
+            'db': [spec.db_min, spec.db_max],
+            'audio': [self.manifest['audio_bytes'], len(clip.data)],
+            'samplerate': clip.samplerate,
+            'duration': clip.duration,
+            'digest': clip.digest,
+            'row': len(self._features),
+        }
+        self._levels.write(levels.tobytes())
+        self._audio.write(clip.data)
+        self._features.append(spec_descriptor(spec))
+        self.manifest['levels_bytes'] += levels.nbytes
+        self.manifest['audio_bytes'] += len(clip.data)
+        self.manifest['clusters'].setdefault(cluster, {}).setdefault(period, {})[filename] = entry
+
+    def abort(self):
+        self._levels.close()
+        self._audio.close()
+        shutil.rmtree(self._scratch, ignore_errors=True)
+
+    def close(self):
+        self._levels.close()
+        self._audio.close()
+        try:
+            features = np.array(self._features, dtype=np.float32).reshape(-1, DESCRIPTOR_DIM)
+            self.manifest['features'] = {'rows': len(features), 'dim': DESCRIPTOR_DIM}
+            manifest = json.dumps(self.manifest, separators=(',', ':')).encode()
+            tmp_path = f"{self.path}.part"
+            with open(tmp_path, 'wb') as f:
+                f.write(_HEADER.pack(MAGIC, len(manifest)))
+                f.write(manifest)
+                f.write(b'\0' * (_data_start(len(manifest)) - _HEADER.size - len(manifest)))
+                for name in ('levels', 'audio'):
+                    with open(os.path.join(self._scratch, name), 'rb') as src:
+                        shutil.copyfileobj(src, f, 1 << 20)
+                padding = _features_offset(self.manifest['levels_bytes'], self.manifest['audio_bytes']) \
+                    - self.manifest['levels_bytes'] - self.manifest['audio_bytes']
+                f.write(b'\0' * padding)
+                f.write(features.tobytes())
+            os.replace(tmp_path, self.path)
+        finally:
+            shutil.rmtree(self._scratch, ignore_errors=True)
+
+
+class SpectrogramBundle:
+    # Read side of a bundle written by prerender.py. The file is memory-mapped once: dB levels
+    # come back as zero-copy views and audio as byte slices, so opening a subfolder needs no
+    # ZIP, no decode and no FFT. Browsed like UploadStore (clusters/periods/files/read);
+    # `features` is the descriptor matrix, row i belonging to feature_keys()[i].
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, manifest_size = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a spectrogram bundle")
+        self.manifest = json.loads(self._mmap[_HEADER.size:_HEADER.size + manifest_size])
+        if self.manifest['version'] != BUNDLE_VERSION:
+            raise ValueError(f"{path} has bundle version {self.manifest['version']}, expected {BUNDLE_VERSION}: "
+                             f"run prerender.py again")
+        self.params = self.manifest['params']
+        self._levels_start = _data_start(manifest_size)
+        self._audio_start = self._levels_start + self.manifest['levels_bytes']
+        self._buffer = np.frombuffer(self._mmap, dtype=np.uint8)
+        rows, dim = self.manifest['features']['rows'], self.manifest['features']['dim']
+        features_start = self._levels_start + _features_offset(self.manifest['levels_bytes'],
+                                                               self.manifest['audio_bytes'])
+        self.features = np.frombuffer(self._mmap, dtype=np.float32, count=rows * dim,
+                                      offset=features_start).reshape(rows, dim)
+
+    def __bool__(self):
+        return bool(self.manifest['clusters'])
+    def clusters(self):
+        return sorted(self.manifest['clusters'])
+
+    def periods(self, cluster):
+        return sorted(self.manifest['clusters'].get(cluster, {}))
+
+    def files(self, cluster, period):
+        return sorted(self.manifest['clusters'].get(cluster, {}).get(period, {}))
+
+    def feature_keys(self):
+        keys = [None] * len(self.features)
+        for cluster, periods in self.manifest['clusters'].items():
+            for period, files in periods.items():
+                for filename, entry in files.items():
+                    keys[entry['row']] = (cluster, period, filename)
+        return keys
+
+    def entry(self, cluster, period, filename):
+        return self.manifest['clusters'][cluster][period][filename]
+
+    def read(self, cluster, period, filename):
+        offset, size = self.entry(cluster, period, filename)['audio']
+        start = self._audio_start + offset
+        return self._mmap[start:start + size]
+
+    def clip(self, cluster, period, filename):
+        entry = self.entry(cluster, period, filename)
+        return AudioClip(filename, self.read(cluster, period, filename), digest=entry['digest'])
+
+    def spec(self, cluster, period, filename):
+        entry = self.entry(cluster, period, filename)
+        offset, rows, cols = entry['levels']
+        start = self._levels_start + offset
+        levels = self._buffer[start:start + rows * cols].reshape(rows, cols)
+        return SpecImage(levels, entry['ext'], *entry['db'])
+
+    def png(self, cluster, period, filename, cmap, cache=None):
+        # Only the colormap is applied at request time; PNGs share the app's spectrogram cache keys
+        key = spec_key(self.entry(cluster, period, filename)['digest'], cmap, **self.params)
+        data = cache.get(key) if cache is not None else None
+        if data is None:
+            data = colorize(self.spec(cluster, period, filename), cmap)
+            if cache is not None:
+                cache.put(key, data)
+        return data
+
+
+class BundleCache:
+    # One mapping per bundle path, shared by every session. A bundle rewritten by prerender.py
+    # (new mtime) is mapped again and the old one dropped, not closed: sessions that fetched it
+    # earlier in their rerun keep using it, and it is unmapped (freeing the replaced file's
+    # space) once the last of them and its views, e.g. a feature index, let go.
+
+    def __init__(self):
+        self._bundles = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            bundle = self._bundles.get(path)
+            if bundle is None or bundle.mtime != mtime:
+                if bundle is not None:
+                    logger.debug(f"{path} was rewritten, mapping it again")
+                bundle = self._bundles[path] = SpectrogramBundle(path)
+            return bundle
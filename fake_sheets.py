@@ -0,0 +1,160 @@
+import glob
+import os
+import threading
+import time
+from collections import Counter
+
+from gspread.exceptions import WorksheetNotFound
+from gspread.utils import a1_to_rowcol, numericise
+
+
+class FakeWorksheet:
+    # In-memory stand-in for gspread.Worksheet: the calls annotator.py makes, with call counting
+
+    def __init__(self, client, title, rows=None):
+        self._client = client
+        self.title = title
+        self._values = [list(row) for row in rows or []]
+
+    @property
+    def row_count(self):
+        return max(len(self._values), 1000)
+
+    def _count(self, name):
+        self._client.count(name)
+
+    def get_all_values(self):
+        self._count('get_all_values')
+        return [list(row) for row in self._values]
+
+    def get_all_records(self):
+        self._count('get_all_records')
+        if not self._values:
+            return []
+        header = self._values[0]
+        # Like gspread, numeric-looking strings come back as numbers
+        return [dict(zip(header, [numericise(v) if isinstance(v, str) else v
+                                  for v in row + [''] * (len(header) - len(row))]))
+                for row in self._values[1:]]
+
+    def row_values(self, row):
+        self._count('row_values')
+        return list(self._values[row - 1]) if row <= len(self._values) else []
+
+    def _write(self, first_row, first_col, values):
+        for r, row in enumerate(values):
+            index = first_row - 1 + r
+            while len(self._values) <= index:
+                self._values.append([])
+            target = self._values[index]
+            end = first_col - 1 + len(row)
+            if len(target) < end:
+                target.extend([''] * (end - len(target)))
+            target[first_col - 1:end] = row
+
+    def update(self, values, range_name=None, **kwargs):
+        # gspread 6 accepts update(values) or update(values, range_name)
+        self._count('update')
+        start = (range_name or 'A1').split(':')[0]
+        self._write(*a1_to_rowcol(start), values)
+
+    def update_cell(self, row, col, value):
+        self._count('update_cell')
+        self._write(row, col, [[value]])
+
+    def batch_update(self, data, **kwargs):
+        self._count('batch_update')
+        for item in data:
+            self._write(*a1_to_rowcol(item['range'].split(':')[0]), item['values'])
+
+    def batch_clear(self, ranges):
+        self._count('batch_clear')
+        for a1 in ranges:
+            first, _, last = a1.partition(':')
+            if first.isdigit():
+                # Whole-row range such as "10:1000"
+                del self._values[int(first) - 1:int(last or first)]
+            else:
+                (r0, c0), (r1, c1) = a1_to_rowcol(first), a1_to_rowcol(last or first)
+                for row in self._values[r0 - 1:r1]:
+                    row[c0 - 1:c1] = [''] * len(row[c0 - 1:c1])
+
+    def clear(self):
+        self._count('clear')
+        self._values = []
+
+    def append_row(self, row, **kwargs):
+        self._count('append_row')
+        self._values.append(list(row))
+
+    def append_rows(self, rows, **kwargs):
+        self._count('append_rows')
+        self._values.extend(list(row) for row in rows)
+
+
+class FakeSpreadsheet:
+
+    def __init__(self, client, title):
+        self._client = client
+        self.title = title
+        self._worksheets = {}
+
+    def worksheet(self, title):
+        self._client.count('worksheet')
+        if title not in self._worksheets:
+            if not self._client.autocreate:
+                raise WorksheetNotFound(title)
+            self.add_worksheet(title)
+        return self._worksheets[title]
+
+    def add_worksheet(self, title, rows=None):
+        self._worksheets[title] = FakeWorksheet(self._client, title, rows)
+        return self._worksheets[title]
+
+
+class FakeClient:
+    # Stand-in for an authorized gspread client. Every API-equivalent call is counted in
+    # `calls`; `latency` adds a fixed delay per call to mimic the network round trip.
+
+    def __init__(self, latency=0.0, autocreate=False):
+        self.latency = latency
+        self.autocreate = autocreate
+        self.calls = Counter()
+        self._spreadsheets = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def open(self, title):
+        self.count('open')
+        if title not in self._spreadsheets:
+            self._spreadsheets[title] = FakeSpreadsheet(self, title)
+        return self._spreadsheets[title]
+
+    def add_worksheet(self, spreadsheet, title, rows=None):
+        # Set-up helper, not counted as an API call
+        if spreadsheet not in self._spreadsheets:
+            self._spreadsheets[spreadsheet] = FakeSpreadsheet(self, spreadsheet)
+        return self._spreadsheets[spreadsheet].add_worksheet(title, rows)
+
+    @classmethod
+    def from_csv_dir(cls, directory, **kwargs):
+        # Offline stand-in seeded from local {rec_name}_all_CLUSTERS_COMBINED.csv exports,
+        # with their change logs replayed so edits not yet compacted into the CSV are included
+        from annotations import read_local_annotations
+        client = cls(autocreate=True, **kwargs)
+        for path in glob.glob(os.path.join(directory, "*_all_CLUSTERS_COMBINED.csv")):
+            rec_name = os.path.basename(path)[:-len("_all_CLUSTERS_COMBINED.csv")]
+            df = read_local_annotations(path, keep_default_na=False)
+            client.add_worksheet("XP_final_annotations", rec_name,
+                                 [df.columns.tolist()] + df.astype(object).values.tolist())
+        client.add_worksheet("XP_annotation_status", "status", [['cluster_folder', 'user', 'status', 'timestamp']])
+        return client
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
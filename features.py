@@ -0,0 +1,96 @@
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+# Descriptor: mean and spread over time of the dB spectrum pooled into mel-spaced bands
+N_BANDS = 32
+DESCRIPTOR_DIM = 2 * N_BANDS
+
+
+@lru_cache(maxsize=32)
+def band_pooling(n_bins, fmin, fmax, n_bands=N_BANDS):
+    # (n_bins, n_bands) averaging matrix from linear frequency bins to mel-spaced bands
+    mel = 2595 * np.log10(1 + np.linspace(fmin, fmax, n_bins) / 700)
+    edges = np.linspace(mel[0], mel[-1], n_bands + 1)
+    band = np.clip(np.searchsorted(edges, mel, side='right') - 1, 0, n_bands - 1)
+    weights = np.zeros((n_bins, n_bands), dtype=np.float32)
+    weights[np.arange(n_bins), band] = 1
+    weights /= np.maximum(weights.sum(axis=0), 1)
+    return weights
+
+
+def spec_descriptor(spec):
+    # Unit-length float32 vector for a SpecImage, from the same dB levels the spectrogram shows.
+    # The mean level is removed so a louder or quieter copy of the same call still matches.
+    db = spec.levels.astype(np.float32) * np.float32((spec.db_max - spec.db_min) / 255) + np.float32(spec.db_min)
+    bands = band_pooling(db.shape[0], spec.ext[2], spec.ext[3]).T @ db
+    descriptor = np.concatenate([bands.mean(axis=1), bands.std(axis=1)])
+    descriptor[:N_BANDS] -= descriptor[:N_BANDS].mean()
+    norm = np.linalg.norm(descriptor)
+    return descriptor / norm if norm > 0 else descriptor
+
+
+class FeatureIndex:
+    # Descriptors of one recorder's ROIs in a single contiguous float32 matrix, row i belonging to
+    # keys[i] = (cluster, period, filename). Similarity is cosine, i.e. one matrix-vector product.
+    # Built from a bundle's feature section (read-only, memory-mapped) or grown as ROIs are rendered.
+
+    def __init__(self, matrix=None, keys=(), source=None, dim=DESCRIPTOR_DIM):
+        self.source = source
+        self._matrix = matrix if matrix is not None else np.zeros((0, dim), dtype=np.float32)
+        self._size = len(keys)
+        self.keys = list(keys)
+        self._rows = {filename: row for row, (_, _, filename) in enumerate(self.keys)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, filename):
+        return filename in self._rows
+
+    @property
+    def matrix(self):
+        return self._matrix[:self._size]
+
+    def add(self, keys, descriptors):
+        # New ROIs are appended; the matrix grows by doubling so it stays one contiguous block
+        with self._lock:
+            new = [(key, descriptor) for key, descriptor in zip(keys, descriptors) if key[2] not in self._rows]
+            if not new:
+                return
+            if self._size + len(new) > len(self._matrix) or not self._matrix.flags.writeable:
+                capacity = max(2 * len(self._matrix), self._size + len(new), 256)
+                matrix = np.empty((capacity, self._matrix.shape[1]), dtype=np.float32)
+                matrix[:self._size] = self._matrix[:self._size]
+                self._matrix = matrix
+            for key, descriptor in new:
+                self._matrix[self._size] = descriptor
+                self._rows[key[2]] = self._size
+                self.keys.append(key)
+                self._size += 1
+
+    def nearest(self, file_names, k=20, allowed=None, excluded=()):
+        # Top-k ROIs closest to the centroid of the example ROIs, best first: [((cluster, period, filename), similarity)].
+        # `allowed` (a set of filenames) restricts the candidates, e.g. to unannotated ROIs; `excluded` removes some.
+        with self._lock:
+            matrix = self.matrix
+            rows = [self._rows[f] for f in file_names if f in self._rows]
+            allowed_rows = None if allowed is None else [self._rows[f] for f in allowed if f in self._rows]
+            excluded_rows = [self._rows[f] for f in excluded if f in self._rows]
+        if not rows:
+            return []
+        query = matrix[rows].mean(axis=0)
+        scores = matrix @ (query / max(np.linalg.norm(query), 1e-12))
+        candidates = np.ones(len(scores), dtype=bool)
+        if allowed_rows is not None:
+            candidates[:] = False
+            candidates[allowed_rows] = True
+        candidates[rows] = False
+        candidates[excluded_rows] = False
+        candidates = np.flatnonzero(candidates)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(self.keys[row], float(scores[row])) for row in candidates]
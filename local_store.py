@@ -0,0 +1,178 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import perf
+from annotations import apply_annotations, index_annotations
+from sheets import write_changed_rows
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS edits (
+    rec_name TEXT NOT NULL,
+    filename_ts TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    synced_version INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (rec_name, filename_ts)
+)
+"""
+
+
+class LocalAnnotationStore:
+    # Submitted annotations, committed locally first and keyed on (rec_name, filename_ts).
+    # Re-submitting a ROI before it has been synced overwrites its payload and bumps its
+    # version, so the sync worker only ever sends the latest edit for each row.
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # One short-lived connection per call: the store is used from script and worker threads
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @perf.timed('local_commit')
+    def commit(self, rec_name, annotations):
+        now = datetime.now().isoformat(timespec='seconds')
+        rows = [(rec_name, a['file_name'], json.dumps({k: v for k, v in a.items() if k != 'file_name'},
+                                                      default=str), now)
+                for a in annotations]
+        with self._connect() as db:
+            db.executemany("""
+                INSERT INTO edits (rec_name, filename_ts, payload, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (rec_name, filename_ts) DO UPDATE SET
+                    payload = excluded.payload, version = edits.version + 1,
+                    attempts = 0, next_attempt = 0, updated_at = excluded.updated_at
+            """, rows)
+
+    def pending(self, rec_name=None, limit=None, due_only=False):
+        # Edits not yet in the sheet: [(rec_name, filename_ts, payload dict, version)]
+        query = "SELECT rec_name, filename_ts, payload, version FROM edits WHERE version > synced_version"
+        params = []
+        if rec_name is not None:
+            query += " AND rec_name = ?"
+            params.append(rec_name)
+        if due_only:
+            query += " AND next_attempt <= ?"
+            params.append(time.time())
+        query += " ORDER BY updated_at"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._connect() as db:
+            rows = db.execute(query, params).fetchall()
+        return [(rec, filename, json.loads(payload), version) for rec, filename, payload, version in rows]
+
+    def pending_count(self):
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM edits WHERE version > synced_version").fetchone()[0]
+
+    def sync_counts(self):
+        # (edits not yet in the sheet, how many of them have failed to sync at least once)
+        with self._connect() as db:
+            return tuple(db.execute("""
+                SELECT COUNT(*), COALESCE(SUM(attempts > 0), 0) FROM edits WHERE version > synced_version
+            """).fetchone())
+
+    def overlay(self, rec_name, annotations_df):
+        # Show edits that are still waiting to be synced on top of a frame read from the sheet
+        annotations = [dict(payload, file_name=filename) for _, filename, payload, _ in self.pending(rec_name)]
+        if annotations:
+            apply_annotations(annotations_df, annotations)
+        return annotations_df
+
+    def mark_synced(self, rec_name, versions):
+        # Only rows still at the version that was pushed; newer edits stay pending
+        with self._connect() as db:
+            db.executemany("""
+                UPDATE edits SET synced_version = ?, attempts = 0, next_attempt = 0
+                WHERE rec_name = ? AND filename_ts = ? AND version = ?
+            """, [(version, rec_name, filename, version) for filename, version in versions])
+
+    def mark_failed(self, rec_name, filenames, max_delay=300):
+        with self._connect() as db:
+            db.executemany("""
+                UPDATE edits SET attempts = attempts + 1,
+                    next_attempt = ? + MIN(?, (1 << MIN(attempts, 16)))
+                WHERE rec_name = ? AND filename_ts = ?
+            """, [(time.time(), max_delay, rec_name, filename) for filename in filenames])
+
+
+def push_to_sheet(sheets, spreadsheet, rec_name, annotations):
+    # Apply one coalesced batch to the sheet; row positions are taken from a fresh read.
+    # The shared records list is neither replaced nor invalidated: the app's annotation frame and
+    # cluster index already carry these edits, and are only rebuilt when the sheet is re-read on its TTL.
+    records = sheets.records(spreadsheet, rec_name, ttl=0, store=False)
+    annotations_df = index_annotations(records)
+    changed_files = apply_annotations(annotations_df, annotations)
+    annotations_df['validated_class'] = annotations_df['validated_class'].astype(str)
+    write_changed_rows(sheets, spreadsheet, rec_name, annotations_df, changed_files, invalidate=False)
+
+
+class SyncWorker:
+    # Background write-behind from the local store to XP_final_annotations.
+    # Syncs once on start (edits left pending by an earlier process), then wakes on submit
+    # (or every `interval` seconds), pushes pending edits per recorder in batches, and backs
+    # off exponentially per row when a push fails.
+
+    def __init__(self, store, sheets, spreadsheet="XP_final_annotations", batch_size=500, interval=10):
+        self.store = store
+        self.sheets = sheets
+        self.spreadsheet = spreadsheet
+        self.batch_size = batch_size
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="annotation-sync", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=30)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync_once()
+            except Exception:
+                logger.exception("Annotation sync failed")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def sync_once(self):
+        pending = self.store.pending(limit=self.batch_size, due_only=True)
+        batches = {}
+        for rec_name, filename, payload, version in pending:
+            batches.setdefault(rec_name, []).append((filename, payload, version))
+        for rec_name, batch in batches.items():
+            annotations = [dict(payload, file_name=filename) for filename, payload, _ in batch]
+            try:
+                push_to_sheet(self.sheets, self.spreadsheet, rec_name, annotations)
+            except Exception as e:
+                logger.warning(f"Sync of {len(batch)} {rec_name} annotations failed, will retry: {e}")
+                self.store.mark_failed(rec_name, [filename for filename, _, _ in batch])
+                continue
+            self.store.mark_synced(rec_name, [(filename, version) for filename, _, version in batch])
+            logger.debug(f"Synced {len(batch)} {rec_name} annotations")
+        return len(pending)
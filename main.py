@@ -1,8 +1,5 @@
 import streamlit as st
 from streamlit_option_menu import option_menu
-import pyrebase
-
-import annotator
 
 # APP PAGE SETTINGS
 
@@ -59,13 +56,16 @@ firebaseConfig = {
     'measurementId': st.secrets["config_firebase"]['measurementId'],
 }
 
-fire = pyrebase.initialize_app(firebaseConfig)
-auth = fire.auth()
 
-# DATABASE
+@st.cache_resource
+def get_firebase(config):
+    # Created once per server process rather than on every rerun; pyrebase is imported here so the header paints first
+    import pyrebase
+    fire = pyrebase.initialize_app(config)
+    return fire, fire.auth(), fire.database(), fire.storage()
+
 
-db = fire.database()
-storage = fire.storage()
+fire, auth, db, storage = get_firebase(firebaseConfig)
 
 # MAIN APP
 
@@ -124,6 +124,8 @@ if st.session_state.signout:
                       orientation='horizontal')
 
     if bio == 'Identification':
+        # The Sheets and signal-processing stacks are only loaded once someone opens this page
+        import annotator
         annotator.iden()
 
     st.markdown('#')
@@ -0,0 +1,96 @@
+import contextvars
+import functools
+import json
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+# The rerun being measured in the current script thread (None outside a rerun, e.g. in worker threads)
+_current = contextvars.ContextVar('perf_run', default=None)
+_history = {}
+_history_lock = threading.Lock()
+_log_path = None
+_log_lock = threading.Lock()
+HISTORY = 200
+
+
+def configure(log_path=None, history=HISTORY):
+    # JSON lines are appended to log_path (one record per rerun) when it is set
+    global _log_path, HISTORY
+    _log_path = log_path
+    HISTORY = history
+
+
+def begin_run(page, session=None):
+    run = {'page': page, 'session': session, 'started': time.perf_counter(),
+           'timestamp': datetime.now().isoformat(timespec='milliseconds'),
+           'spans': Counter(), 'calls': Counter(), 'counters': Counter()}
+    _current.set(run)
+    return run
+
+
+def end_run():
+    run = _current.get()
+    if run is None:
+        return None
+    _current.set(None)
+    record = {
+        'timestamp': run['timestamp'],
+        'page': run['page'],
+        'session': run['session'],
+        'total': time.perf_counter() - run.pop('started'),
+        'spans': dict(run['spans']),
+        'calls': dict(run['calls']),
+        'counters': dict(run['counters']),
+    }
+    with _history_lock:
+        for name, seconds in [('total', record['total'])] + list(record['spans'].items()):
+            _history.setdefault(name, deque(maxlen=HISTORY)).append(seconds)
+    if _log_path:
+        with _log_lock, open(_log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return record
+
+
+@contextmanager
+def span(name):
+    run = _current.get()
+    if run is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        run['spans'][name] += time.perf_counter() - start
+        run['calls'][name] += 1
+
+
+def timed(name):
+    # Decorator form of span()
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    run = _current.get()
+    if run is not None:
+        run['counters'][name] += n
+
+
+def percentiles():
+    # Rolling p50/p95 per span over the last HISTORY reruns, all sessions together
+    with _history_lock:
+        samples = {name: list(values) for name, values in _history.items()}
+    return {name: {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)),
+                   'n': len(values)}
+            for name, values in samples.items()}
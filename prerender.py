@@ -0,0 +1,93 @@
+"""Pre-render a recorder's cluster ZIPs into a spectrogram/audio bundle the app can memory-map.
+
+    python prerender.py rec1dmu clusters_part1.zip clusters_part2.zip --output bundles/
+
+Point the app's "bundle_dir" setting at the output directory: recorders with a bundle are
+browsed from it directly, without a ZIP upload and without computing any spectrogram.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from audio import AudioClip
+from bundle import BundleWriter, bundle_path
+from spectrogram import DB_RANGE, NOVERLAP, NPERSEG, compute_spec
+from uploads import zip_members
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def _archive(zip_path):
+    # One open ZipFile per worker process and archive
+    return zipfile.ZipFile(zip_path, 'r')
+
+
+def render_member(zip_path, member, nperseg, noverlap, db_range):
+    # Process-pool entry point: returns (original WAV bytes, SpecImage) for one ROI
+    clip = AudioClip(os.path.basename(member), _archive(zip_path).read(member))
+    return clip.data, compute_spec(clip.samples(), clip.samplerate, nperseg, noverlap, db_range)
+
+
+def collect_members(zip_paths, suffix=".WAV"):
+    # Same cluster/period/file layout as the uploader; a file present in several archives is taken from the last one
+    members = {}
+    for zip_path in zip_paths:
+        with zipfile.ZipFile(zip_path, 'r') as archive:
+            for cluster, period, filename, info in zip_members(archive, suffix):
+                members[(cluster, period, filename)] = (zip_path, info.filename)
+    return [(key, members[key]) for key in sorted(members)]
+
+
+def prerender(rec_name, zip_paths, output, workers=None, nperseg=NPERSEG, noverlap=NOVERLAP, db_range=DB_RANGE):
+    members = collect_members(zip_paths)
+    if not members:
+        raise ValueError(f"No ROIs found in {', '.join(zip_paths)}")
+    path = bundle_path(output, rec_name)
+    writer = BundleWriter(path, rec_name, nperseg, noverlap, db_range)
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(render_member, *zip(*[(zip_path, member, nperseg, noverlap, db_range)
+                                                     for _, (zip_path, member) in members]),
+                               chunksize=16)
+            # map() yields in submission order, so entries land in the bundle sorted by cluster/period/file
+            for i, (((cluster, period, filename), _), (data, spec)) in enumerate(zip(members, results), 1):
+                writer.add(cluster, period, filename, AudioClip(filename, data), spec)
+                if i % 500 == 0:
+                    logger.info(f"{i}/{len(members)} ROIs rendered")
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    logger.info(f"Wrote {len(members)} ROIs to {path} in {time.perf_counter() - start:.1f}s "
+                f"({os.path.getsize(path) / 1e6:.1f} MB)")
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('rec_name', help="recorder the ZIPs belong to, e.g. rec1dmu")
+    parser.add_argument('zips', nargs='+', help="cluster ZIP archives laid out as <cluster>/<period>/<ROI>.WAV")
+    parser.add_argument('--output', default='.', help="directory the <rec_name>.bundle file is written to")
+    parser.add_argument('--workers', type=int, default=None, help="process pool size (default: all CPUs)")
+    parser.add_argument('--nperseg', type=int, default=NPERSEG)
+    parser.add_argument('--noverlap', type=int, default=NOVERLAP)
+    parser.add_argument('--db-range', type=int, default=DB_RANGE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    os.makedirs(args.output, exist_ok=True)
+    try:
+        prerender(args.rec_name, args.zips, args.output, args.workers, args.nperseg, args.noverlap, args.db_range)
+    except ValueError as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main()
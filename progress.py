@@ -0,0 +1,83 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from annotations import unannotated_mask
+
+
+class ClusterIndex:
+    # cluster_number -> period -> ROI filenames for one recorder, with total/unannotated counts
+    # per cluster and per period. Built with one groupby over the annotations frame; submits
+    # update the rows they touch instead of rebuilding. `source` is the records list the frame
+    # was built from, so callers can tell when the sheet has been re-read and the index is stale.
+
+    def __init__(self, annotations_df, source=None):
+        self.source = source
+        self._lock = threading.Lock()
+        # Per sheet row (frame position): its node and whether it still needs work
+        self._clusters = annotations_df['cluster_number'].astype(str).to_numpy(dtype=object)
+        self._periods = annotations_df['period'].astype(str).to_numpy(dtype=object)
+        self._pending = unannotated_mask(annotations_df).to_numpy(dtype=bool, copy=True)
+        filenames = annotations_df.index.to_numpy(dtype=object)
+        self._filenames = filenames
+        rows = pd.DataFrame({'cluster': self._clusters, 'period': self._periods, 'pending': self._pending})
+        # sort=False keeps clusters and periods in sheet order, as the folder selectboxes list them
+        grouped = rows.groupby(['cluster', 'period'], sort=False)
+        counts = grouped['pending'].agg(['size', 'sum'])
+        # Filenames split out per node in one pass over the rows sorted by group
+        order = np.argsort(grouped.ngroup().values, kind='stable')
+        chunks = np.split(filenames[order], np.cumsum(counts['size'].values)[:-1])
+        self.files = {}
+        self.period_counts = {}
+        for cluster, period, total, pending, filenames in zip(counts.index.get_level_values(0).tolist(),
+                                                              counts.index.get_level_values(1).tolist(),
+                                                              counts['size'].tolist(), counts['sum'].tolist(), chunks):
+            self.files.setdefault(cluster, {})[period] = filenames.tolist()
+            self.period_counts.setdefault(cluster, {})[period] = {'total': total, 'unannotated': int(pending)}
+        self.cluster_counts = {cluster: {'total': sum(c['total'] for c in periods.values()),
+                                         'unannotated': sum(c['unannotated'] for c in periods.values())}
+                               for cluster, periods in self.period_counts.items()}
+
+    def update(self, annotations_df, file_names):
+        # Re-check the submitted ROIs and move only the counts that changed
+        positions = np.flatnonzero(annotations_df.index.isin(file_names))
+        pending = unannotated_mask(annotations_df.iloc[positions]).values
+        with self._lock:
+            for position, now in zip(positions, pending):
+                if now == self._pending[position]:
+                    continue
+                self._pending[position] = now
+                delta = 1 if now else -1
+                cluster, period = self._clusters[position], self._periods[position]
+                self.period_counts[cluster][period]['unannotated'] += delta
+                self.cluster_counts[cluster]['unannotated'] += delta
+
+    def unannotated_folders(self):
+        # {cluster: [periods with ROIs left]} for clusters that still need work
+        with self._lock:
+            return {cluster: [period for period, counts in periods.items() if counts['unannotated']]
+                    for cluster, periods in self.period_counts.items()
+                    if self.cluster_counts[cluster]['unannotated']}
+
+    def cluster_files(self, clusters):
+        # Every ROI filename of the given clusters
+        return {filename for cluster in clusters for filenames in self.files.get(cluster, {}).values()
+                for filename in filenames}
+
+    def unannotated_files(self):
+        with self._lock:
+            return set(self._filenames[self._pending])
+
+    def summary(self):
+        with self._lock:
+            counts = list(self.cluster_counts.values())
+        rois = sum(c['total'] for c in counts)
+        remaining = sum(c['unannotated'] for c in counts)
+        return {
+            'clusters': len(counts),
+            'clusters_started': sum(c['unannotated'] < c['total'] for c in counts),
+            'clusters_done': sum(c['unannotated'] == 0 for c in counts),
+            'rois': rois,
+            'rois_annotated': rois - remaining,
+        }
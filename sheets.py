@@ -0,0 +1,150 @@
+import logging
+import random
+import threading
+import time
+
+import numpy as np
+from gspread.exceptions import APIError
+from gspread.utils import rowcol_to_a1
+
+import perf
+
+logger = logging.getLogger(__name__)
+
+
+def with_backoff(call, *args, retries=5, **kwargs):
+    # Retry rate-limited (429) and transient 5xx Sheets calls with jittered exponential backoff
+    for attempt in range(retries + 1):
+        try:
+            return call(*args, **kwargs)
+        except APIError as e:
+            code = e.response.status_code
+            if attempt == retries or (code != 429 and code < 500):
+                raise
+            delay = min(2 ** attempt, 32) + random.random()
+            logger.debug(f"Sheets API returned {code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+class SheetsCache:
+    # Read-through cache over a gspread client, shared by every session of the app process.
+    # Spreadsheet and worksheet handles are opened once; get_all_records() results are kept
+    # for `ttl` seconds per worksheet and dropped whenever this layer writes to that worksheet
+    # (except for writes made with invalidate=False).
+
+    def __init__(self, get_client, ttl=60):
+        self._get_client = get_client
+        self.ttl = ttl
+        self.api_calls = 0
+        self._spreadsheets = {}
+        self._worksheets = {}
+        self._records = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _call(self, call, *args, **kwargs):
+        self.api_calls += 1
+        perf.count('sheets_api_calls')
+        return with_backoff(call, *args, **kwargs)
+
+    def spreadsheet(self, name):
+        with self._key_lock(name):
+            if name not in self._spreadsheets:
+                self._spreadsheets[name] = self._call(self._get_client().open, name)
+            return self._spreadsheets[name]
+
+    def worksheet(self, spreadsheet, name):
+        key = (spreadsheet, name)
+        with self._key_lock(key):
+            if key not in self._worksheets:
+                self._worksheets[key] = self._call(self.spreadsheet(spreadsheet).worksheet, name)
+            return self._worksheets[key]
+
+    def records(self, spreadsheet, name, ttl=None, store=True):
+        # The returned list is shared between callers and must not be mutated.
+        # store=False reads without replacing the cached list other callers hold.
+        key = (spreadsheet, name)
+        ttl = self.ttl if ttl is None else ttl
+        # Per-worksheet lock: concurrent sessions wait for one fetch instead of each hitting the API
+        with self._key_lock(('records',) + key):
+            cached = self._records.get(key)
+            if cached is not None and time.monotonic() - cached[0] < ttl:
+                perf.count('sheets_cache_hit')
+                return cached[1]
+            perf.count('sheets_cache_miss')
+            with perf.span('sheet_read'):
+                records = self._call(self.worksheet(spreadsheet, name).get_all_records)
+            if store:
+                self._records[key] = (time.monotonic(), records)
+            return records
+
+    def invalidate(self, spreadsheet, name=None):
+        with self._lock:
+            for key in list(self._records):
+                if key[0] == spreadsheet and name in (None, key[1]):
+                    del self._records[key]
+
+    def update(self, spreadsheet, name, values, **kwargs):
+        try:
+            return self._call(self.worksheet(spreadsheet, name).update, values, **kwargs)
+        finally:
+            self.invalidate(spreadsheet, name)
+
+    def batch_update(self, spreadsheet, name, data, invalidate=True, **kwargs):
+        try:
+            return self._call(self.worksheet(spreadsheet, name).batch_update, data, **kwargs)
+        finally:
+            if invalidate:
+                self.invalidate(spreadsheet, name)
+
+    def batch_clear(self, spreadsheet, name, ranges):
+        try:
+            return self._call(self.worksheet(spreadsheet, name).batch_clear, ranges)
+        finally:
+            self.invalidate(spreadsheet, name)
+
+    def append_rows(self, spreadsheet, name, rows, **kwargs):
+        try:
+            return self._call(self.worksheet(spreadsheet, name).append_rows, rows, **kwargs)
+        finally:
+            self.invalidate(spreadsheet, name)
+
+
+def write_full_sheet(sheets, spreadsheet, name, annotations_df):
+    # Overwrite in place and clear only leftover rows, so readers never see an empty sheet
+    with perf.span('sheet_write'):
+        sheets.update(spreadsheet, name, [annotations_df.columns.values.tolist()] + annotations_df.values.tolist())
+        row_count = sheets.worksheet(spreadsheet, name).row_count
+        if row_count > len(annotations_df) + 1:
+            sheets.batch_clear(spreadsheet, name, [f"{len(annotations_df) + 2}:{row_count}"])
+
+
+def write_changed_rows(sheets, spreadsheet, name, annotations_df, changed_files, invalidate=True):
+    # Send only the changed rows, grouped into contiguous ranges, in a single batch_update.
+    # invalidate=False keeps the cached records, for writers whose readers already hold the change.
+    if not changed_files:
+        return
+    if annotations_df.attrs.get('sheet_columns') != list(annotations_df.columns):
+        # Columns were added or reordered since the sheet was read: row positions can't be trusted
+        write_full_sheet(sheets, spreadsheet, name, annotations_df)
+        return
+    positions = np.flatnonzero(annotations_df.index.isin(changed_files))
+    rows = annotations_df.iloc[positions].astype(object)
+    rows = rows.where(rows.notna(), '').values.tolist()
+    n_cols = len(annotations_df.columns)
+    data = []
+    start = 0
+    for end in range(1, len(positions) + 1):
+        if end == len(positions) or positions[end] != positions[end - 1] + 1:
+            # Position i in the frame is sheet row i + 2 (row 1 is the header)
+            first_row, last_row = positions[start] + 2, positions[end - 1] + 2
+            data.append({'range': f"{rowcol_to_a1(first_row, 1)}:{rowcol_to_a1(last_row, n_cols)}",
+                         'values': rows[start:end]})
+            start = end
+    with perf.span('sheet_write'):
+        sheets.batch_update(spreadsheet, name, data, invalidate=invalidate)
+    logger.debug(f"Wrote {len(positions)} rows in {len(data)} ranges to {name}")
@@ -0,0 +1,348 @@
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.ticker import MaxNLocator
+from PIL import Image, ImageDraw, ImageFont
+
+import perf
+from audio import AudioClip, open_clip
+
+logger = logging.getLogger(__name__)
+
+# Default STFT / display parameters, shared by the app and the cache keys
+NPERSEG = 1024
+NOVERLAP = 512
+DB_RANGE = 70
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    # Hash of the file contents, so the same ROI extracted into a new temp dir still hits the cache
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def spec_key(digest, cmap, nperseg=NPERSEG, noverlap=NOVERLAP, db_range=DB_RANGE):
+    return f"{digest}_{nperseg}_{noverlap}_{db_range}_{cmap}"
+
+
+class SpectrogramCache:
+    # In-memory LRU of rendered PNG (or serialized SpecImage) bytes bounded by a byte budget,
+    # with an optional on-disk tier
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, disk_dir=None, suffix='.png'):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._items:
+                return True
+        path = self._disk_path(key)
+        return path is not None and os.path.exists(path)
+
+    @property
+    def size(self):
+        return self._size
+
+    def _disk_path(self, key):
+        if not self.disk_dir:
+            return None
+        return os.path.join(self.disk_dir, f"{key}{self.suffix}")
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                perf.count(f"{self.suffix.lstrip('.')}_cache_hit")
+                return data
+        path = self._disk_path(key)
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            self._put_memory(key, data)
+            with self._lock:
+                self.hits += 1
+            perf.count(f"{self.suffix.lstrip('.')}_cache_hit")
+            return data
+        with self._lock:
+            self.misses += 1
+        perf.count(f"{self.suffix.lstrip('.')}_cache_miss")
+        return None
+
+    def put(self, key, data):
+        self._put_memory(key, data)
+        path = self._disk_path(key)
+        if path and not os.path.exists(path):
+            # Write then rename so a concurrent reader never sees a partial PNG
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+# Layout of the rendered image, in pixels (matplotlib's 100 dpi figure sizes)
+MARGIN_LEFT, MARGIN_RIGHT, MARGIN_TOP, MARGIN_BOTTOM = 62, 58, 8, 34
+COLORBAR_WIDTH, COLORBAR_GAP = 10, 8
+_SPEC_HEADER = struct.Struct('<6d2i')
+
+
+class SpecImage:
+    # Spectrogram in dB, normalized to uint8 levels so it can be recoloured with a lookup table.
+    # levels[0] is the lowest frequency bin; ext is (tmin, tmax, fmin, fmax) as in sound.spectrogram.
+
+    def __init__(self, levels, ext, db_min, db_max):
+        self.levels = levels
+        self.ext = tuple(float(v) for v in ext)
+        self.db_min = float(db_min)
+        self.db_max = float(db_max)
+
+    @property
+    def duration(self):
+        return self.ext[1] - self.ext[0]
+
+    def to_bytes(self):
+        rows, cols = self.levels.shape
+        return _SPEC_HEADER.pack(*self.ext, self.db_min, self.db_max, rows, cols) + self.levels.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        *ext, db_min, db_max, rows, cols = _SPEC_HEADER.unpack_from(data)
+        levels = np.frombuffer(data, dtype=np.uint8, offset=_SPEC_HEADER.size).reshape(rows, cols)
+        return cls(levels, ext, db_min, db_max)
+
+
+@perf.timed('spectrogram_compute')
+def compute_spec(s, fs, nperseg=NPERSEG, noverlap=NOVERLAP, db_range=DB_RANGE):
+    # maad pulls in most of scipy (~2s); imported on first use, so a server that only serves
+    # cached or pre-rendered spectrograms (the STFT runs in the pool workers) never loads it
+    from maad import sound
+    from maad.util import power2dB
+    from skimage import transform
+    Sxx, tn, fn, ext = sound.spectrogram(s, fs, nperseg=nperseg, noverlap=noverlap, flims=(0, fs // 2))
+    Sxx_db = power2dB(Sxx, db_range=db_range)
+    Sxx_db = transform.rescale(Sxx_db, 0.5, anti_aliasing=True, channel_axis=None)
+    db_min, db_max = float(Sxx_db.min()), float(Sxx_db.max())
+    scale = 255.0 / (db_max - db_min) if db_max > db_min else 0.0
+    levels = np.rint((Sxx_db - db_min) * scale).astype(np.uint8)
+    return SpecImage(levels, ext, db_min, db_max)
+
+
+def figure_pixels(duration):
+    # Adjust figure size based on the duration of the audio file
+    if duration < 1:
+        return 200, 200
+    elif duration < 2:
+        return 250, 200
+    elif duration < 3:
+        return 400, 250
+    return 500, 350
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(cmap):
+    return (colormaps[cmap](np.linspace(0, 1, 256))[:, :3] * 255).round().astype(np.uint8)
+
+
+def _text(draw, xy, text, font, align='center', valign='top'):
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    x, y = xy
+    x -= {'left': 0, 'center': (right - left) / 2, 'right': right - left}[align]
+    y -= {'top': 0, 'middle': (bottom - top) / 2}[valign]
+    draw.text((x, y), text, fill='black', font=font)
+
+
+@lru_cache(maxsize=64)
+def axes_overlay(width, height, ext, db_min, db_max):
+    # Frame, ticks, labels and colorbar scale drawn once per layout as a transparent RGBA layer
+    tmin, tmax, fmin, fmax = ext
+    x0, y0 = MARGIN_LEFT, MARGIN_TOP
+    x1, y1 = width - MARGIN_RIGHT, height - MARGIN_BOTTOM
+    cx0 = x1 + COLORBAR_GAP
+    cx1 = cx0 + COLORBAR_WIDTH
+    overlay = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    font = ImageFont.load_default()
+    draw.rectangle([x0 - 1, y0 - 1, x1, y1], outline='black')
+    draw.rectangle([cx0 - 1, y0 - 1, cx1, y1], outline='black')
+    for t in MaxNLocator(nbins=4).tick_values(tmin, tmax):
+        if tmin <= t <= tmax and tmax > tmin:
+            x = x0 + (t - tmin) / (tmax - tmin) * (x1 - x0)
+            draw.line([(x, y1), (x, y1 + 3)], fill='black')
+            _text(draw, (x, y1 + 5), f"{t:g}", font)
+    for f in MaxNLocator(nbins=4).tick_values(fmin, fmax):
+        if fmin <= f <= fmax and fmax > fmin:
+            y = y1 - (f - fmin) / (fmax - fmin) * (y1 - y0)
+            draw.line([(x0 - 4, y), (x0 - 1, y)], fill='black')
+            _text(draw, (x0 - 6, y), f"{f:g}", font, align='right', valign='middle')
+    for db in MaxNLocator(nbins=4).tick_values(db_min, db_max):
+        if db_min <= db <= db_max and db_max > db_min:
+            y = y1 - (db - db_min) / (db_max - db_min) * (y1 - y0)
+            draw.line([(cx1, y), (cx1 + 3, y)], fill='black')
+            _text(draw, (cx1 + 5, y), f"{db:+2.0f} dB", font, align='left', valign='middle')
+    _text(draw, ((x0 + x1) / 2, height - 14), 'Time [s]', font)
+    label = Image.new('RGBA', (y1 - y0, 12), (0, 0, 0, 0))
+    _text(ImageDraw.Draw(label), ((y1 - y0) / 2, 0), 'Frequency [Hz]', font)
+    label = label.rotate(90, expand=True)
+    overlay.alpha_composite(label, (2, y0))
+    return overlay
+
+
+@perf.timed('image_render')
+def colorize(spec, cmap, size=None):
+    # Colormap via lookup table straight into RGB uint8, composited under the cached axes layer
+    width, height = size or figure_pixels(spec.duration)
+    x0, y0 = MARGIN_LEFT, MARGIN_TOP
+    x1, y1 = width - MARGIN_RIGHT, height - MARGIN_BOTTOM
+    lut = colormap_lut(cmap)
+    canvas = Image.new('RGB', (width, height), 'white')
+    image = Image.fromarray(lut[spec.levels[::-1]]).resize((x1 - x0, y1 - y0), Image.BILINEAR)
+    canvas.paste(image, (x0, y0))
+    colorbar = Image.fromarray(lut[::-1][:, None, :].repeat(COLORBAR_WIDTH, axis=1)).resize(
+        (COLORBAR_WIDTH, y1 - y0), Image.BILINEAR)
+    canvas.paste(colorbar, (x1 + COLORBAR_GAP, y0))
+    overlay = axes_overlay(width, height, tuple(round(v, 3) for v in spec.ext),
+                           round(spec.db_min, 1), round(spec.db_max, 1))
+    canvas.paste(overlay, (0, 0), overlay)
+    buf = io.BytesIO()
+    canvas.save(buf, format='PNG', compress_level=1)
+    return buf.getvalue()
+
+
+def render_spec(source, cmap, nperseg=NPERSEG, noverlap=NOVERLAP, db_range=DB_RANGE):
+    # Process-pool entry point: returns (serialized SpecImage, PNG bytes).
+    # `source` is the WAV bytes the caller already read, or a path when nothing has read the file yet.
+    clip = AudioClip('', source) if isinstance(source, bytes) else open_clip(source)
+    spec = compute_spec(clip.samples(), clip.samplerate, nperseg, noverlap, db_range)
+    return spec.to_bytes(), colorize(spec, cmap)
+
+
+class SpectrogramRenderer:
+    # Renders whole subfolders across a process pool and prefetches the next one in the background
+
+    def __init__(self, cache, workers=None, spec_cache=None):
+        self.cache = cache
+        self.spec_cache = spec_cache
+        # spawn rather than fork: the Streamlit server is multi-threaded
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self._prefetcher = ThreadPoolExecutor(max_workers=1)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def render(self, audio_files, cmap, nperseg=NPERSEG, noverlap=NOVERLAP, db_range=DB_RANGE, clips=None):
+        # Returns PNG bytes for each file, in the same order as audio_files.
+        # Pass `clips` when the caller already holds the files: their digests key the cache and their
+        # bytes go to the workers, so no file is read twice.
+        batch = (tuple(audio_files), cmap, nperseg, noverlap, db_range)
+        with self._lock:
+            pending = self._pending.get(batch)
+        with perf.span('spectrogram_render'):
+            if pending is not None:
+                # Already being prefetched: wait for it instead of rendering the same files twice
+                try:
+                    return pending.result()
+                except Exception:
+                    logger.debug("Prefetch failed, rendering in the foreground", exc_info=True)
+            return self._render(audio_files, cmap, nperseg, noverlap, db_range, clips)
+
+    def prefetch(self, audio_files, cmap, nperseg=NPERSEG, noverlap=NOVERLAP, db_range=DB_RANGE):
+        batch = (tuple(audio_files), cmap, nperseg, noverlap, db_range)
+        with self._lock:
+            if batch in self._pending:
+                return self._pending[batch]
+            future = self._prefetcher.submit(self._render, audio_files, cmap, nperseg, noverlap, db_range)
+            self._pending[batch] = future
+        future.add_done_callback(lambda f: self._done(batch, f))
+        return future
+
+    def _done(self, batch, future):
+        with self._lock:
+            self._pending.pop(batch, None)
+        if future.exception() is not None:
+            logger.debug(f"Spectrogram prefetch failed: {future.exception()}")
+
+    def _render(self, audio_files, cmap, nperseg, noverlap, db_range, clips=None):
+        digests = [clip.digest for clip in clips] if clips else [file_digest(f) for f in audio_files]
+        keys = [spec_key(digest, cmap, nperseg, noverlap, db_range) for digest in digests]
+        images = [self.cache.get(key) for key in keys]
+        missing = []
+        for i, image in enumerate(images):
+            if image is not None:
+                continue
+            # A colormap change only needs the cached dB levels recoloured, no STFT
+            spec_bytes = self.spec_cache.get(self._db_key(digests[i], nperseg, noverlap, db_range)) \
+                if self.spec_cache is not None else None
+            if spec_bytes is not None:
+                images[i] = colorize(SpecImage.from_bytes(spec_bytes), cmap)
+                self.cache.put(keys[i], images[i])
+            else:
+                missing.append(i)
+        if missing:
+            logger.debug(f"Rendering {len(missing)}/{len(audio_files)} spectrograms in the process pool")
+            futures = [self._pool.submit(render_spec, clips[i].data if clips else audio_files[i],
+                                         cmap, nperseg, noverlap, db_range)
+                       for i in missing]
+            for i, future in zip(missing, futures):
+                spec_bytes, images[i] = future.result()
+                self.cache.put(keys[i], images[i])
+                if self.spec_cache is not None:
+                    self.spec_cache.put(self._db_key(digests[i], nperseg, noverlap, db_range), spec_bytes)
+        return images
+
+    def spec(self, digest, nperseg=NPERSEG, noverlap=NOVERLAP, db_range=DB_RANGE):
+        # dB levels of an already rendered ROI, or None
+        if self.spec_cache is None:
+            return None
+        spec_bytes = self.spec_cache.get(self._db_key(digest, nperseg, noverlap, db_range))
+        return SpecImage.from_bytes(spec_bytes) if spec_bytes is not None else None
+
+    @staticmethod
+    def _db_key(digest, nperseg, noverlap, db_range):
+        return spec_key(digest, 'db', nperseg, noverlap, db_range)
+
+    def shutdown(self):
+        self._prefetcher.shutdown(wait=False, cancel_futures=True)
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,145 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+from gspread.utils import rowcol_to_a1
+
+import perf
+
+logger = logging.getLogger(__name__)
+
+STATUS_COLUMNS = ['cluster_folder', 'user', 'status', 'timestamp']
+CLAIMED = 'claimed'
+IN_PROGRESS = 'in-progress'
+DONE = 'done'
+RELEASED = 'released'
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def status_key(rec_name, folder):
+    # Cluster numbers repeat across recorders, so the status sheet is keyed on both
+    return f"{rec_name}/{folder}"
+
+
+class AnnotationStatus:
+    # Cached view of the XP_annotation_status sheet with queued, batched writes.
+    # One instance is shared by every session of the app process, so its lock
+    # serializes claims between annotators on the same server; claims are also
+    # re-read after writing to catch a concurrent writer from another process.
+
+    def __init__(self, sheets, spreadsheet="XP_annotation_status", worksheet="status", ttl=30,
+                 claim_expiry=4 * 3600):
+        self._sheets = sheets
+        self.spreadsheet = spreadsheet
+        self.worksheet = worksheet
+        self.ttl = ttl
+        self.claim_expiry = claim_expiry
+        self._table = None
+        self._loaded_at = 0.0
+        self._queue = OrderedDict()
+        self._lock = threading.RLock()
+
+    def table(self, force=False):
+        with self._lock:
+            if force or self._table is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._refresh()
+            table = self._table.copy()
+            # Show queued changes as if they were already written
+            for folder, (user, status, timestamp) in self._queue.items():
+                table = _set_row(table, folder, user, status, timestamp)
+            return table
+
+    def _refresh(self):
+        df = pd.DataFrame(self._sheets.records(self.spreadsheet, self.worksheet, ttl=0))
+        for column in STATUS_COLUMNS:
+            if column not in df.columns:
+                df[column] = ''
+        df[STATUS_COLUMNS] = df[STATUS_COLUMNS].astype(str)
+        self._table = df
+        self._loaded_at = time.monotonic()
+
+    def _active(self, table):
+        # Claims nobody has touched for claim_expiry seconds are treated as abandoned
+        timestamps = pd.to_datetime(table['timestamp'], format=TIME_FORMAT, errors='coerce')
+        fresh = (datetime.now() - timestamps).dt.total_seconds() < self.claim_expiry
+        return table[table['status'].isin([CLAIMED, IN_PROGRESS]) & fresh.fillna(False)]
+
+    def owner(self, folder, table=None):
+        table = self.table() if table is None else table
+        active = self._active(table)
+        owners = active.loc[active['cluster_folder'] == folder, 'user']
+        return owners.iloc[0] if len(owners) else None
+
+    def claimed_by_others(self, user):
+        active = self._active(self.table())
+        return set(active.loc[active['user'] != user, 'cluster_folder'])
+
+    def claim(self, folder, user):
+        # Compare-and-set: only claim a folder that is free, expired or already ours.
+        # One read for the compare (reused for the write's ownership check and row positions), the write,
+        # one read to confirm.
+        with self._lock:
+            owner = self.owner(folder, self.table(force=True))
+            if owner not in (None, user):
+                return False
+            self._queue[folder] = (user, CLAIMED, datetime.now().strftime(TIME_FORMAT))
+            self._write_queue()
+            won = self.owner(folder, self.table(force=True)) == user
+            if not won:
+                logger.debug(f"Lost the claim on {folder} to another annotator")
+            return won
+
+    def release(self, folder, user):
+        # Hand a claimed folder back; flush drops it if someone else owns the folder by then
+        self.set_status(folder, user, RELEASED)
+
+    def set_status(self, folder, user, status):
+        with self._lock:
+            self._queue[folder] = (user, status, datetime.now().strftime(TIME_FORMAT))
+
+    @perf.timed('status_write')
+    def flush(self):
+        # Apply every queued change in one batch_update (plus one append for new folders), checked
+        # against a fresh read so a change to a folder someone else has taken over is dropped
+        with self._lock:
+            if not self._queue:
+                return
+            self._refresh()
+            self._write_queue()
+
+    def _write_queue(self):
+        # Write the queue against self._table, which the caller has just read
+        with self._lock:
+            table = self._table
+            active = self._active(table)
+            updates, appends = [], []
+            for folder, (user, status, timestamp) in self._queue.items():
+                owners = active.loc[active['cluster_folder'] == folder, 'user']
+                if len(owners) and owners.iloc[0] not in ('', user):
+                    logger.debug(f"Dropping status change for {folder}: claimed by {owners.iloc[0]}")
+                    continue
+                rows = table.index[table['cluster_folder'] == folder]
+                if len(rows):
+                    row = rows[0] + 2
+                    updates.append({'range': f"{rowcol_to_a1(row, 1)}:{rowcol_to_a1(row, len(STATUS_COLUMNS))}",
+                                    'values': [[folder, user, status, timestamp]]})
+                else:
+                    appends.append([folder, user, status, timestamp])
+            if updates:
+                self._sheets.batch_update(self.spreadsheet, self.worksheet, updates)
+            if appends:
+                self._sheets.append_rows(self.spreadsheet, self.worksheet, appends)
+            self._queue.clear()
+            self._loaded_at = 0.0
+
+
+def _set_row(table, folder, user, status, timestamp):
+    mask = table['cluster_folder'] == folder
+    if mask.any():
+        table.loc[mask, ['user', 'status', 'timestamp']] = [user, status, timestamp]
+        return table
+    row = pd.DataFrame([[folder, user, status, timestamp]], columns=STATUS_COLUMNS)
+    return pd.concat([table, row], ignore_index=True)
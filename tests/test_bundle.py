@@ -0,0 +1,72 @@
+import gc
+import io
+import os
+
+import numpy as np
+import soundfile as sf
+
+from audio import AudioClip
+from bundle import BundleCache, BundleWriter
+from features import FeatureIndex
+from spectrogram import SpecImage
+
+
+def write_bundle(path, n_files=3, seed=0):
+    rng = np.random.default_rng(seed)
+    writer = BundleWriter(path, 'rec')
+    for i in range(n_files):
+        buf = io.BytesIO()
+        sf.write(buf, (0.1 * rng.standard_normal(4800)).astype(np.float32), 48000, format='WAV', subtype='PCM_16')
+        spec = SpecImage(rng.integers(0, 256, (64, 20), dtype=np.uint8), (0, 0.1, 0, 24000), -70, 0)
+        writer.add('1', '00h', f"f{i}.WAV", AudioClip(f"f{i}.WAV", buf.getvalue()), spec)
+    writer.close()
+
+
+def rewrite(path, seed):
+    mtime = os.path.getmtime(path)
+    write_bundle(path, seed=seed)
+    os.utime(path, (mtime + 10, mtime + 10))
+
+
+def mapped_deleted(path):
+    with open('/proc/self/maps') as f:
+        return any(os.path.basename(path) in line and '(deleted)' in line for line in f)
+
+
+def test_rewritten_bundle_is_mapped_again(tmp_path):
+    path = str(tmp_path / "rec.bundle")
+    write_bundle(path)
+    cache = BundleCache()
+    old = cache.get(path)
+    assert cache.get(path) is old
+    rewrite(path, seed=1)
+    new = cache.get(path)
+    assert new is not old
+    assert cache.get(path) is new
+
+
+def test_old_bundle_stays_usable_by_sessions_holding_it(tmp_path):
+    path = str(tmp_path / "rec.bundle")
+    write_bundle(path)
+    cache = BundleCache()
+    old = cache.get(path)
+    expected = old.spec('1', '00h', 'f0.WAV').levels.copy()
+    rewrite(path, seed=1)
+    cache.get(path)
+    # Another session fetched `old` earlier in its rerun and is still rendering from it
+    assert old.clip('1', '00h', 'f0.WAV').duration == 0.1
+    assert np.array_equal(old.spec('1', '00h', 'f0.WAV').levels, expected)
+
+
+def test_replaced_mapping_is_released_with_its_last_holder(tmp_path):
+    path = str(tmp_path / "rec.bundle")
+    write_bundle(path)
+    cache = BundleCache()
+    old = cache.get(path)
+    index = FeatureIndex(old.features, old.feature_keys(), source=old)
+    rewrite(path, seed=1)
+    cache.get(path)
+    assert mapped_deleted(path)
+    del old, index
+    gc.collect()
+    assert not mapped_deleted(path)
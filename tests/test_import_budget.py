@@ -0,0 +1,34 @@
+import ast
+import os
+
+import pytest
+
+from bench import IDENTIFICATION_MODULES, LOGIN_MODULES, import_time, import_violations
+
+# Cold-start budgets in seconds, as passed to bench.py --import-budget / --login-import-budget
+IDENTIFICATION_BUDGET = 1.5
+LOGIN_BUDGET = 2.0
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_identification_modules_cover_annotator_imports():
+    # Every repository module annotator.py imports at load time has to be measured
+    with open(os.path.join(ROOT, 'annotator.py')) as f:
+        tree = ast.parse(f.read())
+    imported = {alias.name for node in tree.body if isinstance(node, ast.Import) for alias in node.names}
+    imported |= {node.module for node in tree.body if isinstance(node, ast.ImportFrom)}
+    local = {name for name in imported if os.path.exists(os.path.join(ROOT, f"{name}.py"))}
+    assert local <= set(IDENTIFICATION_MODULES)
+
+
+def test_identification_imports_within_budget():
+    # Also fails when the Identification modules load the STFT stack
+    report = {'identification': import_time(IDENTIFICATION_MODULES)}
+    assert import_violations(report, {'identification': IDENTIFICATION_BUDGET}) == []
+
+
+def test_login_imports_within_budget():
+    pytest.importorskip('streamlit')
+    report = {'login': import_time(LOGIN_MODULES), 'identification': {}}
+    assert import_violations(report, {'login': LOGIN_BUDGET}) == []
@@ -0,0 +1,45 @@
+import time
+
+from fake_sheets import FakeClient
+from local_store import LocalAnnotationStore, SyncWorker
+from sheets import SheetsCache
+
+HEADER = ['filename_ts', 'cluster_number', 'period', 'validated_class', 'validated_specie', 'validator_name', 'comment']
+
+
+def annotation(file_name, group):
+    return {'file_name': file_name, 'group_input': group, 'scientific_name_input': 'sp. A',
+            'validator_name_input': 'me', 'comment_input': ''}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_worker_pushes_edits_left_by_an_earlier_process(tmp_path):
+    client = FakeClient()
+    client.add_worksheet("XP_final_annotations", "rec", [HEADER, ['f0.WAV', 1, '00h', 0, 0, 0, '']])
+    path = str(tmp_path / "annotations.sqlite3")
+    LocalAnnotationStore(path).commit("rec", [annotation('f0.WAV', 'bird')])
+    # A new process: its worker has to sync on start, without waiting for a submit or its interval
+    store = LocalAnnotationStore(path)
+    worker = SyncWorker(store, SheetsCache(lambda: client), interval=3600)
+    try:
+        assert wait_for(lambda: store.sync_counts() == (0, 0))
+    finally:
+        worker.stop()
+    assert client.open("XP_final_annotations").worksheet("rec").get_all_records()[0]['validated_class'] == 'bird'
+
+
+def test_failed_pushes_are_counted(tmp_path):
+    client = FakeClient()
+    store = LocalAnnotationStore(str(tmp_path / "annotations.sqlite3"))
+    store.commit("missing", [annotation('f0.WAV', 'bird')])
+    worker = SyncWorker(store, SheetsCache(lambda: client), interval=3600)
+    try:
+        assert wait_for(lambda: store.sync_counts() == (1, 1))
+    finally:
+        worker.stop()
@@ -0,0 +1,63 @@
+import pytest
+
+from annotations import apply_annotations, index_annotations
+from fake_sheets import FakeClient
+from sheets import SheetsCache, write_changed_rows
+
+HEADER = ['filename_ts', 'cluster_number', 'period', 'validated_class', 'validated_specie', 'validator_name', 'comment']
+
+
+@pytest.fixture
+def sheets():
+    client = FakeClient()
+    client.add_worksheet("XP_final_annotations", "rec", [HEADER] + [[f"f{i}.WAV", 1, '00h', 0, 0, 0, '']
+                                                                    for i in range(8)])
+    sheets = SheetsCache(lambda: client)
+    sheets.batches = []
+    batch_update = sheets.batch_update
+
+    def recording_batch_update(spreadsheet, name, data, **kwargs):
+        sheets.batches.append([item['range'] for item in data])
+        return batch_update(spreadsheet, name, data, **kwargs)
+
+    sheets.batch_update = recording_batch_update
+    return sheets
+
+
+def edit(sheets, positions):
+    annotations_df = index_annotations(sheets.records("XP_final_annotations", "rec"))
+    changed = apply_annotations(annotations_df, [{
+        'file_name': f"f{i}.WAV", 'group_input': 'bird', 'scientific_name_input': f"sp. {i}",
+        'validator_name_input': 'me', 'comment_input': ''} for i in positions])
+    write_changed_rows(sheets, "XP_final_annotations", "rec", annotations_df, changed)
+    return sheets.records("XP_final_annotations", "rec", ttl=0)
+
+
+def test_contiguous_rows_are_one_range(sheets):
+    records = edit(sheets, [2, 3, 4])
+    # Frame position i is sheet row i + 2, below the header
+    assert sheets.batches == [['A4:G6']]
+    assert [r['validated_specie'] for r in records] == [0, 0, 'sp. 2', 'sp. 3', 'sp. 4', 0, 0, 0]
+
+
+def test_non_contiguous_rows_are_separate_ranges(sheets):
+    records = edit(sheets, [0, 5, 6])
+    assert sheets.batches == [['A2:G2', 'A7:G8']]
+    assert [r['validated_specie'] for r in records] == ['sp. 0', 0, 0, 0, 0, 'sp. 5', 'sp. 6', 0]
+    assert [r['filename_ts'] for r in records] == [f"f{i}.WAV" for i in range(8)]
+
+
+def test_no_changes_write_nothing(sheets):
+    annotations_df = index_annotations(sheets.records("XP_final_annotations", "rec"))
+    write_changed_rows(sheets, "XP_final_annotations", "rec", annotations_df, [])
+    assert sheets.batches == []
+
+
+def test_new_column_rewrites_the_sheet(sheets):
+    annotations_df = index_annotations(sheets.records("XP_final_annotations", "rec"))
+    annotations_df['extra'] = 'x'
+    write_changed_rows(sheets, "XP_final_annotations", "rec", annotations_df, ['f1.WAV'])
+    # Row positions can't be trusted once the layout changed: full write instead of row ranges
+    assert sheets.batches == []
+    records = sheets.records("XP_final_annotations", "rec", ttl=0)
+    assert [r['extra'] for r in records] == ['x'] * 8
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from fake_sheets import FakeClient
+from sheets import SheetsCache
+from status import CLAIMED, DONE, STATUS_COLUMNS, TIME_FORMAT, AnnotationStatus
+
+FOLDER = 'rec1dmu/7'
+
+
+@pytest.fixture
+def client():
+    client = FakeClient()
+    client.add_worksheet("XP_annotation_status", "status", [STATUS_COLUMNS])
+    return client
+
+
+def service(client, **kwargs):
+    # One per simulated app server: each has its own Sheets cache over the same sheet
+    return AnnotationStatus(SheetsCache(lambda: client), **kwargs)
+
+
+def rows(client):
+    return client.open("XP_annotation_status").worksheet("status").get_all_values()[1:]
+
+
+def age(client, folder, seconds):
+    # Backdate a folder's status timestamp, as if it was last touched `seconds` ago
+    worksheet = client.open("XP_annotation_status").worksheet("status")
+    timestamp = (datetime.now() - timedelta(seconds=seconds)).strftime(TIME_FORMAT)
+    for row in worksheet._values[1:]:
+        if row[0] == folder:
+            row[3] = timestamp
+
+
+def test_second_claim_on_a_folder_fails(client):
+    a, b = service(client), service(client)
+    assert a.claim(FOLDER, 'a')
+    assert not b.claim(FOLDER, 'b')
+    assert b.owner(FOLDER) == 'a'
+    assert FOLDER in b.claimed_by_others('b')
+    assert FOLDER not in a.claimed_by_others('a')
+
+
+def test_owner_can_claim_again(client):
+    a = service(client)
+    assert a.claim(FOLDER, 'a')
+    assert a.claim(FOLDER, 'a')
+    assert len(rows(client)) == 1
+
+
+def test_release_frees_the_folder(client):
+    a, b = service(client), service(client)
+    a.claim(FOLDER, 'a')
+    a.release(FOLDER, 'a')
+    a.flush()
+    assert FOLDER not in b.claimed_by_others('b')
+    assert b.claim(FOLDER, 'b')
+
+
+def test_release_after_takeover_is_dropped(client):
+    a, b = service(client, claim_expiry=60), service(client, claim_expiry=60)
+    a.claim(FOLDER, 'a')
+    age(client, FOLDER, 120)
+    assert b.claim(FOLDER, 'b')
+    a.release(FOLDER, 'a')
+    a.flush()
+    assert rows(client)[0][1:3] == ['b', CLAIMED]
+    assert service(client).owner(FOLDER) == 'b'
+
+
+def test_status_change_on_a_foreign_claim_is_dropped(client):
+    a, b = service(client), service(client)
+    a.claim(FOLDER, 'a')
+    b.set_status(FOLDER, 'b', DONE)
+    b.flush()
+    assert rows(client)[0][1:3] == ['a', CLAIMED]
+
+
+def test_expired_claim_can_be_taken_over(client):
+    # ttl=0: b re-reads the sheet on every check instead of serving its cached table
+    a, b = service(client, claim_expiry=60), service(client, ttl=0, claim_expiry=60)
+    a.claim(FOLDER, 'a')
+    age(client, FOLDER, 30)
+    assert not b.claim(FOLDER, 'b')
+    age(client, FOLDER, 120)
+    assert FOLDER not in b.claimed_by_others('b')
+    assert b.claim(FOLDER, 'b')
+    assert service(client).owner(FOLDER) == 'b'
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+import perf
+from spectrogram import DB_RANGE, NOVERLAP, NPERSEG, SpecImage, file_digest
+
+logger = logging.getLogger(__name__)
+
+# Levels are stored time-major as (frames, bins) uint8 arrays, so a tile (a fixed number of frames)
+# is one contiguous chunk of its level file. Level 0 holds every STFT frame; each coarser level
+# halves the frames (max-pooled, so short calls stay visible) and, down to MIN_BINS, the bins.
+TILE_FRAMES = 512
+OVERVIEW_FRAMES = 1024
+MIN_BINS = 128
+BLOCK_FRAMES = 256
+# Absolute dB scale of the stored levels; the display window (db_range below the loudest bin)
+# is applied when colouring, so quantization doesn't depend on the rest of the file
+DB_FLOOR, DB_CEIL = -160.0, 0.0
+_LEVEL_SCALE = 255 / (DB_CEIL - DB_FLOOR)
+
+
+def pyramid_key(digest, nperseg=NPERSEG, noverlap=NOVERLAP):
+    return f"{digest}_{nperseg}_{noverlap}"
+
+
+def stft_blocks(source, nperseg=NPERSEG, noverlap=NOVERLAP, block_frames=BLOCK_FRAMES):
+    # PSD frames of the left channel in blocks of `block_frames`, computed in float32 straight from
+    # the file: only one block of samples is ever in memory. Each frame has its mean removed (as
+    # scipy's default detrend does) and its power is one-sided and scaled like mode='psd'.
+    hop = nperseg - noverlap
+    with sf.SoundFile(source) as f:
+        fs = f.samplerate
+        window = np.hanning(nperseg + 1)[:-1].astype(np.float32)
+        scale = np.float32(1 / (fs * float(np.sum(window ** 2))))
+        blocksize = nperseg + hop * (block_frames - 1)
+        for block in f.blocks(blocksize=blocksize, overlap=noverlap, dtype='float32', always_2d=True):
+            samples = block[:, 0]
+            if len(samples) < nperseg:
+                break
+            frames = np.lib.stride_tricks.sliding_window_view(samples, nperseg)[::hop]
+            frames = (frames - frames.mean(axis=1, keepdims=True)) * window
+            power = np.abs(np.fft.rfft(frames, axis=1)) ** 2 * scale
+            power[:, 1:-1] *= 2
+            yield fs, power[:, :nperseg // 2]
+
+
+def _to_levels(power):
+    db = 10 * np.log10(np.maximum(power, np.float32(1e-30)))
+    return np.clip((db - DB_FLOOR) * _LEVEL_SCALE, 0, 255).astype(np.uint8)
+
+
+def _pool(levels, bins):
+    # Pairwise max over time (and over frequency until `bins` is reached)
+    frames = len(levels) // 2 * 2
+    pooled = np.maximum(levels[0:frames:2], levels[1:frames:2])
+    if pooled.shape[1] > bins:
+        pooled = np.maximum(pooled[:, 0::2], pooled[:, 1::2])
+    return pooled
+
+
+@perf.timed('pyramid_build')
+def build_pyramid(source, directory, nperseg=NPERSEG, noverlap=NOVERLAP):
+    # One streaming pass over the audio; every level is written to its memory-mapped file as frames
+    # arrive. Built in a scratch directory and renamed into place, so readers never see half a pyramid.
+    hop = nperseg - noverlap
+    info = sf.info(source)
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    n_frames = max((info.frames - nperseg) // hop + 1, 0)
+    shapes = [(n_frames, nperseg // 2)]
+    while shapes[-1][0] > OVERVIEW_FRAMES:
+        frames, bins = shapes[-1]
+        shapes.append((frames // 2, bins // 2 if bins > MIN_BINS else bins))
+    scratch = tempfile.mkdtemp(prefix="pyramid_", dir=os.path.dirname(directory))
+    try:
+        arrays = [np.lib.format.open_memmap(os.path.join(scratch, f"level{level}.npy"), mode='w+',
+                                            dtype=np.uint8, shape=shape) for level, shape in enumerate(shapes)]
+        written = [0] * len(shapes)
+        carry = [None] * len(shapes)  # per level, a frame still waiting for its pooling partner
+        peak = 0
+        for fs, power in stft_blocks(source, nperseg, noverlap):
+            levels = _to_levels(power)
+            peak = max(peak, int(levels.max(initial=0)))
+            for level, array in enumerate(arrays):
+                count = min(len(levels), len(array) - written[level])
+                array[written[level]:written[level] + count] = levels[:count]
+                written[level] += count
+                if level + 1 == len(arrays):
+                    break
+                if carry[level] is not None:
+                    levels = np.concatenate([carry[level], levels])
+                carry[level] = levels[-1:] if len(levels) % 2 else None
+                levels = _pool(levels, shapes[level + 1][1])
+        for array in arrays:
+            array.flush()
+        meta = {'samplerate': info.samplerate, 'duration': info.frames / info.samplerate,
+                'nperseg': nperseg, 'noverlap': noverlap, 'peak_level': peak,
+                'levels': [{'frames': frames, 'bins': bins, 'frame_seconds': hop * 2 ** level / info.samplerate}
+                           for level, (frames, bins) in enumerate(shapes)]}
+        del arrays
+        with open(os.path.join(scratch, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(scratch, directory)
+    except OSError:
+        shutil.rmtree(scratch, ignore_errors=True)
+        if not os.path.exists(os.path.join(directory, 'meta.json')):
+            raise
+    except BaseException:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+
+
+class SpectrogramPyramid:
+    # Read side of a pyramid directory. Levels are memory-mapped, so a view only pages in the
+    # tiles that cover the requested time range.
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.duration = self.meta['duration']
+        self._levels = [None] * len(self.meta['levels'])
+
+    def level(self, level):
+        if self._levels[level] is None:
+            self._levels[level] = np.load(os.path.join(self.directory, f"level{level}.npy"), mmap_mode='r')
+        return self._levels[level]
+
+    @property
+    def overview_level(self):
+        return len(self.meta['levels']) - 1
+
+    def level_for(self, t0, t1, max_frames=OVERVIEW_FRAMES):
+        # Finest level that shows [t0, t1] in at most max_frames columns
+        for level, info in enumerate(self.meta['levels']):
+            if (t1 - t0) / info['frame_seconds'] <= max_frames:
+                return level
+        return self.overview_level
+
+    def tiles(self, level, t0, t1):
+        # Indices of the TILE_FRAMES-long tiles of `level` that overlap [t0, t1]
+        frame_seconds = self.meta['levels'][level]['frame_seconds']
+        n_tiles = -(-self.meta['levels'][level]['frames'] // TILE_FRAMES)
+        first = max(int(t0 / frame_seconds) // TILE_FRAMES, 0)
+        last = min(int(np.ceil(t1 / frame_seconds)) // TILE_FRAMES, n_tiles - 1)
+        return range(first, last + 1)
+
+    def tile(self, level, index):
+        return self.level(level)[index * TILE_FRAMES:(index + 1) * TILE_FRAMES]
+
+    def view(self, t0=0.0, t1=None, db_range=DB_RANGE, max_frames=OVERVIEW_FRAMES):
+        # SpecImage of [t0, t1] from the finest level that fits, assembled from its tiles and
+        # windowed to db_range below the file's loudest bin, ready for spectrogram.colorize
+        t1 = self.duration if t1 is None else min(t1, self.duration)
+        level = self.level_for(t0, t1, max_frames)
+        info = self.meta['levels'][level]
+        tiles = self.tiles(level, t0, t1)
+        with perf.span('pyramid_view'):
+            frames = np.concatenate([self.tile(level, i) for i in tiles]) if len(tiles) else \
+                np.zeros((0, info['bins']), dtype=np.uint8)
+            start = tiles.start * TILE_FRAMES if len(tiles) else 0
+            first = max(int(t0 / info['frame_seconds']) - start, 0)
+            last = max(min(int(np.ceil(t1 / info['frame_seconds'])) - start, len(frames)), first + 1)
+            frames = frames[first:last]
+            high = self.meta['peak_level']
+            low = max(high - db_range * _LEVEL_SCALE, 0)
+            lut = np.clip((np.arange(256) - low) * 255 / max(high - low, 1), 0, 255).astype(np.uint8)
+            levels = lut[frames.T] if len(frames) else np.zeros((info['bins'], 1), dtype=np.uint8)
+        db_max = DB_FLOOR + high / _LEVEL_SCALE
+        return SpecImage(levels, (t0, t1, 0, self.meta['samplerate'] / 2), db_max - (high - low) / _LEVEL_SCALE, db_max)
+
+
+class PyramidStore:
+    # Pyramids on disk under `root`, one directory per file content and STFT parameters, built on
+    # first use and shared by every session (and by server restarts when root is persistent)
+
+    def __init__(self, root=None):
+        self.root = root or tempfile.mkdtemp(prefix="annotator_tiles_")
+        os.makedirs(self.root, exist_ok=True)
+        self._pyramids = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._builder = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, digest, source, nperseg=NPERSEG, noverlap=NOVERLAP):
+        # `source` is a path or file-like object with the audio, only read when the pyramid is missing
+        key = pyramid_key(digest, nperseg, noverlap)
+        with self._lock:
+            lock = self._key_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._pyramids:
+                directory = os.path.join(self.root, key)
+                if not os.path.exists(os.path.join(directory, 'meta.json')):
+                    build_pyramid(source, directory, nperseg, noverlap)
+                self._pyramids[key] = SpectrogramPyramid(directory)
+            return self._pyramids[key]
+
+    def prefetch(self, path, nperseg=NPERSEG, noverlap=NOVERLAP):
+        # Build the pyramid of a file about to be shown, in the background
+        return self._builder.submit(self._prefetch, path, nperseg, noverlap)
+
+    def _prefetch(self, path, nperseg, noverlap):
+        try:
+            return self.get(file_digest(path), path, nperseg, noverlap)
+        except Exception:
+            logger.debug(f"Pyramid prefetch of {path} failed", exc_info=True)
@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import perf
+
+logger = logging.getLogger(__name__)
+
+
+def upload_digest(uploaded_file, chunk_size=1 << 20):
+    # Hash the upload in place (no copy of a possibly multi-GB buffer)
+    h = hashlib.sha1()
+    buffer = uploaded_file.getbuffer()
+    for start in range(0, len(buffer), chunk_size):
+        h.update(buffer[start:start + chunk_size])
+    return h.hexdigest()
+
+
+def zip_members(archive, suffix=".WAV"):
+    # (cluster, period, filename, ZipInfo) for every ROI laid out as .../<cluster>/<period>/<file>
+    for info in archive.infolist():
+        parts = info.filename.strip('/').split('/')
+        if info.is_dir() or len(parts) < 3 or '__MACOSX' in parts or not parts[-1].endswith(suffix):
+            continue
+        cluster, period, filename = parts[-3:]
+        yield cluster, period, filename, info
+
+
+class UploadStore:
+    # Per-session view of the uploaded cluster ZIPs.
+    # Each archive is hashed once and indexed from its central directory as
+    # cluster -> period -> file; WAVs are read straight from the archive or
+    # extracted lazily, one subfolder at a time, into a cache directory that is
+    # removed when the store is garbage collected (i.e. the session ends) or at exit.
+
+    def __init__(self, suffix=".WAV"):
+        self.suffix = suffix
+        self.cache_dir = tempfile.mkdtemp(prefix="annotator_uploads_")
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.cache_dir, ignore_errors=True)
+        self._archives = {}  # digest -> ZipFile
+        self._upload_ids = {}  # uploader file id -> digest
+        self._index = {}  # cluster -> period -> filename -> (digest, member name)
+        self._extracted = {}
+        self._lock = threading.RLock()
+        self._extract_locks = {}
+        self._extractor = ThreadPoolExecutor(max_workers=1)
+
+    @perf.timed('zip_index')
+    def sync(self, uploaded_files):
+        # Index new uploads and forget the ones removed from the uploader
+        with self._lock:
+            current = {}
+            added = False
+            for uploaded_file in uploaded_files:
+                upload_id = getattr(uploaded_file, 'file_id', None) or (uploaded_file.name, uploaded_file.size)
+                digest = self._upload_ids.get(upload_id)
+                if digest is None:
+                    digest = upload_digest(uploaded_file)
+                    if digest not in self._archives:
+                        self._archives[digest] = zipfile.ZipFile(uploaded_file, 'r')
+                        added = True
+                        logger.debug(f"Indexed upload {uploaded_file.name} ({digest[:10]})")
+                current[upload_id] = digest
+            removed = set(self._upload_ids.values()) - set(current.values())
+            self._upload_ids = current
+            for digest in removed:
+                self._archives.pop(digest).close()
+            if added or removed:
+                self._rebuild_index()
+
+    def _rebuild_index(self):
+        index = {}
+        for digest, archive in self._archives.items():
+            for cluster, period, filename, info in zip_members(archive, self.suffix):
+                index.setdefault(cluster, {}).setdefault(period, {})[filename] = (digest, info.filename)
+        self._index = index
+        self._extracted = {key: path for key, path in self._extracted.items()
+                           if key[0] in index and key[1] in index[key[0]]}
+        logger.debug(f"Upload index: {len(index)} clusters, "
+                     f"{sum(len(files) for periods in index.values() for files in periods.values())} files")
+
+    def __bool__(self):
+        return bool(self._index)
+
+    def clusters(self):
+        return sorted(self._index)
+
+    def periods(self, cluster):
+        return sorted(self._index.get(cluster, {}))
+
+    def files(self, cluster, period):
+        return sorted(self._index.get(cluster, {}).get(period, {}))
+
+    def read(self, cluster, period, filename):
+        # WAV bytes straight from the archive, without touching the disk
+        digest, member = self._index[cluster][period][filename]
+        return self._archives[digest].read(member)
+
+    @perf.timed('zip_extract')
+    def extract(self, cluster, period):
+        # Extract a single subfolder once and return its sorted WAV paths
+        key = (cluster, period)
+        with self._lock:
+            lock = self._extract_locks.setdefault(key, threading.Lock())
+        # Per-subfolder lock: the foreground can extract one subfolder while the next is extracted in the background
+        with lock:
+            if key in self._extracted:
+                return self._extracted[key]
+            files = self._index.get(cluster, {}).get(period, {})
+            target = os.path.join(self.cache_dir, cluster, period)
+            os.makedirs(target, exist_ok=True)
+            paths = []
+            for filename in sorted(files):
+                digest, member = files[filename]
+                path = os.path.join(target, filename)
+                if not os.path.exists(path):
+                    tmp_path = f"{path}.part"
+                    with self._archives[digest].open(member) as src, open(tmp_path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.replace(tmp_path, path)
+                paths.append(path)
+            self._extracted[key] = paths
+            return paths
+
+    def extract_async(self, cluster, period):
+        return self._extractor.submit(self.extract, cluster, period)
+
+    def close(self):
+        self._extractor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            for archive in self._archives.values():
+                archive.close()
+            self._archives.clear()
+        self._finalizer()